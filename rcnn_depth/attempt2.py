@@ -1,27 +1,26 @@
 # Box prediction
 ## Trying again! 
-from PIL import Image, ImageDraw
+from PIL import Image
 import numpy as np
 
 import torch
 import torch.nn as nn
-from skimage import io
 import math
 
-from torch.utils.data import Dataset, DataLoader
-import torch.nn.functional as F
+from torch.utils.data import Dataset
 import os
 
-import seaborn as sns
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
-plt.style.use('ggplot')
-
 import time
 
-
-device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-print("CUDA available? device: ", device)
+from rectgen import make_batch
+from models import Net
+from rectdata import make_loader
+import export
+import evaluate
+import render
+from train import AverageMeter, get_device
+from checkpoint import CheckpointManager
+from metrics import LossHistory
 
 # ---- Make depth images ------------------------------------
 # -----------------------------------------------------------
@@ -30,6 +29,15 @@ IMG_X, IMG_Y = 200,200
 block_l, block_w = 20, 30
 
 batch_size = 15 
+eval_batch_size = 256  # no gradients, so evaluation takes bigger batches
+workers = 4  # number of workers for loading data in the DataLoader
+# frozen TorchScript regressor for inference, see export.py
+export_file = "regrNet_attempt2.pt"
+checkpoint_prefix = "checkpoint_attempt2"
+keep_checkpoints = 3  # last few epochs kept on disk, plus the best one
+# every batch loss is streamed here; checkpoints keep a decimated history
+loss_file = "loss_attempt2.f32"
+results_file = "results_attempt2.png"  # contact sheet of test predictions
 
 
 # -- Calc rectangle vertices. credit Sparkler, stackoverflow, feb 17
@@ -41,30 +49,19 @@ def makeRectangle(l, w, theta, offset=(0, 0)):
 
 # ---- Save to file -------------------
 def make_dataset(dirname, num_images):
-    true_coords = []
     newpath = "./" + dirname
     if not os.path.exists(newpath):
         os.makedirs(newpath)
         print(newpath)
-    for i in range(num_images):
-        # orient = 0 # degrees
-        img = Image.new("RGB", (IMG_X, IMG_Y), "black")
-
-        # block_l and _w offset so blocks don't run off edge of image
-        rand_x = int(np.random.rand() * (IMG_X - 2 * block_l)) + block_l
-        rand_y = int(np.random.rand() * (IMG_Y - 2 * block_w)) + block_w
-        orient = int(np.random.rand() * 180)  # .random() is range [0.0, 1.0).
-        orient = math.radians(orient)  # math.cos takes radians!
-
-        rect_vertices = makeRectangle(
-            block_l, block_w, orient, offset=(rand_x, rand_y))
+    # rasterize the whole set at once, then only write the pngs one by one
+    images, coords = make_batch(num_images, IMG_X, IMG_Y, block_l, block_w)
 
-       # true_coords.append(np.array((rand_x, rand_y, math.degrees(orient))))
-        true_coords.append(np.array((rand_y, rand_x, math.degrees(orient))))
-
-        idraw = ImageDraw.Draw(img)
-        idraw.polygon(rect_vertices, fill="white")
+    # true_coords.append(np.array((rand_x, rand_y, math.degrees(orient))))
+    true_coords = [np.array((y, x, math.degrees(orient)))
+                   for (x, y, orient) in coords]
 
+    for i, image in enumerate(images):
+        img = Image.fromarray(image).convert("RGB")
         img.save(newpath + "/rect" + str(i) + ".png")
     return true_coords
 
@@ -84,6 +81,8 @@ class RectDepthImgsDataset(Dataset):
         return len(self.true_coords)
 
     def __getitem__(self, idx):
+        from skimage import io
+
         # image = self.images[idx]
         image = io.imread(self.img_dir + '/rect'+str(idx)+'.png')
         image = torch.FloatTensor(image).permute(2, 0, 1) #PIL and torch expect difft orders
@@ -101,101 +100,11 @@ class RectDepthImgsDataset(Dataset):
 
 # ---- Define Net ------------------------------------
 # -----------------------------------------------------------
-class Net(nn.Module):  # CIFAR is 32x32x3, MNIST is 28x28pred_x)
-    def __init__(self, IMG_X, IMG_Y):
-        super(Net, self).__init__()
-
-        self._imgx = IMG_X
-        self._imgy = IMG_Y
-        _pool = 2
-        _stride = 5
-        _outputlayers = 16
-
-        num_classes = 3
-
-        def _calc(val):
-            layer_size = (val- (_stride-1)) / _pool
-            return layer_size
-
-        #print(self._imgx)
-        self._const = _calc(_calc(self._imgx))
-        self._const *= _calc(_calc(self._imgy))
-        self._const *= _outputlayers
-        #print(self._const)
-        self._const = int(self._const)
-
-        self.conv1 = nn.Conv2d(3, 6, _stride).to(device)
-        self.pool = nn.MaxPool2d(_pool, _pool).to(device)
-        self.conv2 = nn.Conv2d(6, _outputlayers, _stride).to(device)
-        self.fc1 = nn.Linear(self._const, 120).to(device)
-        self.fc2 = nn.Linear(120, 84).to(device)
-        self.fc3 = nn.Linear(84, num_classes).to(device)
-
-    def forward(self, x):
-        #print(x.size())
-        x = x.to(device)
-        x = x.view(-1, 3, IMG_X, IMG_Y)
-        x = self.pool(F.relu(self.conv1(x)))
-        x = self.pool(F.relu(self.conv2(x)))
-        x = x.view(-1, self._const)
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
-        x = self.fc3(x)
-        return x
+# Net lives in models.py
 
 # -- Utility fxn -------------------------------------------------------
-# Source: https://github.com/sgrvinod/a-PyTorch-Tutorial-to-Object-Detection/blob/master/train.py
-## -------------------------------------
-class AverageMeter(object):
-    """
-    Keeps track of most recent, average, sum, and count of a metric.
-    """
-
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
-def save_checkpoint(epoch, epochs_since_improvement, regrModel,
-                    loss_history,
-                    regrLoss, best_loss, is_best):
-    # Save checkpoint
-    """
-    Save model checkpoint.
-    :param epoch: epoch number
-    :param epochs_since_improvement: number of epochs since last improvement
-    :param model: model
-    :param optimizer: optimizer
-    :param loss: validation loss in this epoch
-    :param best_loss: best validation loss achieved so far (not necessarily in this checkpoint)
-    :param is_best: is this checkpoint the best so far?
-    """
-    state = {
-        "epoch": epoch,
-        "epochs_since_improvement": epochs_since_improvement,
-        "regrModel": regrModel,
-        "regrLoss": regrLoss,
-        "loss_history": loss_history,
-        "best_loss": best_loss,
-        "is_best": is_best
-    }
-
-    filename = "checkpoint_attempt2.tar"
-    torch.save(state, filename)
-    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
-    if is_best:
-        torch.save(state, "BEST_" + filename)
+# AverageMeter lives in train.py
+
 
 # -- Main Functions --------------------------------------------------
 # --------------------------------------------------------------------
@@ -207,19 +116,18 @@ def run_dataset_creation():
         # to things
 
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    print("CUDA available? device: ", device)
+    get_device()
 
     # Dataset is depth images of rectangular blocks
     global train_loader
     train_dataset = RectDepthImgsDataset(img_dir='./data', coords=train_truth)
     # Data loader
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                              shuffle=True)
+    train_loader = make_loader(train_dataset, batch_size=batch_size,
+                               workers=workers)
 
     test_dataset = RectDepthImgsDataset(img_dir='./data/test', coords=test_truth)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size,
-                              shuffle=True)
+    test_loader = make_loader(test_dataset, batch_size=batch_size,
+                              workers=workers)
         
     np.save("train_truth.npy", train_truth)
     np.save("test_truth.npy", test_truth)
@@ -228,6 +136,7 @@ def run_dataset_creation():
 
 
 def train_dataset():
+    device = get_device()
 
     num_classes = 3 # predicting x,y,orientation
     learning_rate = 0.001
@@ -246,7 +155,7 @@ def train_dataset():
     batch_time = AverageMeter()  # forward prop. + back prop. time
     data_time = AverageMeter()  # data loading time
     loss_avg = AverageMeter()  # loss
-    loss_history = []
+    loss_history = LossHistory(filename=loss_file)
 
 
     # -- Instantiate CNN -------------------------
@@ -254,6 +163,22 @@ def train_dataset():
     regrModel = regrModel.to(device)
     optimizer = torch.optim.Adam(regrModel.parameters(), lr=learning_rate)
 
+    # pick up where the last run stopped, if there is one
+    checkpoints = CheckpointManager(".", checkpoint_prefix,
+                                    keep=keep_checkpoints)
+    start_epoch = 0
+    state = checkpoints.resume({"regrModel": regrModel},
+                               {"optimizer": optimizer}, map_location=device)
+    if state is not None:
+        start_epoch = state["epoch"] + 1
+        best_loss = state["best_loss"]
+        epochs_since_improvement = state["epochs_since_improvement"]
+        loss_history.load_state_dict(state["loss_history"])
+        print('Resuming from epoch %d, best loss %.3f' % (start_epoch,
+                                                          best_loss))
+    elif os.path.exists(loss_file):
+        os.remove(loss_file)  # a fresh run starts a fresh history
+
     regrModel.train() # enable dropout
     print('Training model now...')
 
@@ -261,13 +186,13 @@ def train_dataset():
     # -- Load datasets -------------------------
     train_truth = np.load("train_truth.npy")
     train_dataset = RectDepthImgsDataset(img_dir='./data', coords=train_truth)
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size,
-                              shuffle=True)
+    train_loader = make_loader(train_dataset, batch_size=batch_size,
+                               workers=workers)
     
     # -- Begin training -------------------------
     start = time.time()
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
 
         for i_batch, (images, labels) in enumerate(train_loader):
             data_time.update(time.time() - start)
@@ -278,7 +203,7 @@ def train_dataset():
             outputs = regrModel(images).to(device)
 
             regrLoss = criterion(outputs, labels)
-            loss_history.append(regrLoss)
+            loss_history.append(regrLoss)  # keeps the value, not the graph
 
             optimizer.zero_grad()
             regrLoss.backward()
@@ -317,82 +242,76 @@ def train_dataset():
         else:
             epochs_since_improvement = 0
 
-        # Save checkpoint
-        save_checkpoint(epoch, epochs_since_improvement, regrModel,
-                        loss_history,
-                        loss_avg.avg, best_loss, is_best)
+        # Save checkpoint, written in the background
+        checkpoints.save(epoch, {"regrModel": regrModel},
+                         {"optimizer": optimizer}, is_best=is_best,
+                         epochs_since_improvement=epochs_since_improvement,
+                         regrLoss=loss_avg.avg, best_loss=best_loss,
+                         loss_history=loss_history.state_dict())
+
+    checkpoints.close()
+    # rgb / yx / degrees: how evaluate.py should feed and read the model
+    export.export_model(regrModel, export_file,
+                        metadata={"IMG_X": IMG_X, "IMG_Y": IMG_Y,
+                                  "epoch": num_epochs - 1,
+                                  "best_loss": best_loss,
+                                  "rgb": True, "yx": True, "degrees": True})
+    regrModel.train()
 
 
 # --- VIEW RESULTS ----------------------------------------
 # ---------------------------------------------------------
 
 def view_loss_results():
-    filename = "checkpoint_attempt2.tar"
-    checkpoint = torch.load(filename)
+    device = get_device()
+    regrModel = Net(IMG_X, IMG_Y).to(device)
+    checkpoint = CheckpointManager(".", checkpoint_prefix).resume(
+        {"regrModel": regrModel}, map_location=device)
+    if checkpoint is None:
+        raise FileNotFoundError("no %s checkpoint in this directory, train "
+                                "first" % checkpoint_prefix)
     start_epoch = checkpoint['epoch'] + 1
     best_loss = checkpoint['best_loss']
-    loss_history = checkpoint['loss_history']
-    regrModel = checkpoint['regrModel']
+    loss_history = LossHistory()
+    loss_history.load_state_dict(checkpoint['loss_history'])
+    regrModel.eval()
 
     print('\nLoaded checkpoint from epoch %d. Best loss so far is %.3f.\n' % (start_epoch, best_loss))
     test_truth = np.load("test_truth.npy")
     test_dataset = RectDepthImgsDataset(img_dir='./data/test', coords=test_truth)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size,
-                              shuffle=True)
-
-    criterion = nn.MSELoss()
-
-    with torch.no_grad():
-        
-        dataiter = iter(test_loader)
-        images, labels = dataiter.next()
-
-        # Move to default device
-        images = images.to(device)
-        labels = labels.to(device)
-
-        # Forward pass
-        outputs = regrModel(images)
-        loss = criterion(outputs, labels)
+    # the whole test set, in big batches, in order
+    test_loader = make_loader(test_dataset, batch_size=eval_batch_size,
+                              workers=workers, shuffle=False)
 
-        # Loss
-        print("loss across batch size of ", labels.size()[0], 'is: \n', loss)
+    outputs, labels = evaluate.evaluate_model(regrModel, test_loader, device)
+    # labels are (y, x, degrees)
+    centerErr, angleErr = evaluate.grasp_errors(outputs, labels, yx=True,
+                                                degrees=True)
+    summary = evaluate.summarize(centerErr, angleErr)
+    for name, value in summary.items():
+        print("%-24s %.4f" % (name, value))
 
-        #print(labels)
-        print('\n!-- labels size', labels.size())
-
-
-        plt.plot(range(len(loss_history)), loss_history) # regr loss
-        plt.show()
-        # plt.xlim((4500, 5100))
-        # plt.ylim((0,30))
-        # plt.show()
-
-        # sns.regplot(x=np.arange(len(loss_history)),
-                    # y=np.array(loss_history)) # regr loss
+    evaluate.plot_loss_history(loss_history.values, loss_history.steps)
 
 
 def view_image_results():
-    filename = "checkpoint_attempt2.tar"
-    checkpoint = torch.load(filename)
-    start_epoch = checkpoint['epoch'] + 1
-    best_loss = checkpoint['best_loss']
-    loss_history = checkpoint['loss_history']
-    regrModel = checkpoint['regrModel']
+    device = get_device()
+    # the exported model, no need to unpickle the training checkpoint
+    regrModel, metadata = export.load_model(export_file, device)
+    start_epoch = metadata['epoch'] + 1
+    best_loss = metadata['best_loss']
 
     print('\nLoaded checkpoint from epoch %d. Best loss so far is %.3f.\n' % (start_epoch, best_loss))
 
     test_truth = np.load("test_truth.npy")
     test_dataset = RectDepthImgsDataset(img_dir='./data/test', coords=test_truth)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=batch_size,
-                              shuffle=True)
-
-    criterion = nn.MSELoss()
+    test_loader = make_loader(test_dataset, batch_size=batch_size,
+                              workers=workers)
 
     with torch.no_grad():
         
         dataiter = iter(test_loader)
-        images, coords = dataiter.next()
+        images, coords = next(dataiter)
 
         # Move to default device
         images = images.to(device)
@@ -401,38 +320,14 @@ def view_image_results():
         # Forward pass
         outputs = regrModel(images)
 
-        labels = coords.cpu()
-
-        plt.rcParams['figure.figsize'] = [50,10]
-
-        fig,ax = plt.subplots()
-
-        print('lenlabels', len(labels))
-
-        for i in range(len(labels)-10):
-            print('i', i)
-            x, y, orient = labels[i].numpy()
-            pred_x, pred_y, orientation_pred = outputs[i].cpu().numpy()
-            
-            orient = np.rad2deg(orient)
-            orientation_pred = np.rad2deg(orientation_pred)
-            
-            truth_rect = patches.Rectangle((x + i * IMG_X, y), 30, 20, angle = orient,
-                                     fill=True, color='black')
-            pred_rect = patches.Rectangle((pred_x + i * IMG_X, pred_y), 30,20, angle =
-                                      orientation_pred, fill=True, color='orange')
-            image_outline = patches.Rectangle((i * IMG_X, 0), 200, 200, angle=0,
-                                              fill=False, color='black')
-
-            ax.add_patch(truth_rect)
-            ax.add_patch(pred_rect)
-            ax.add_patch(image_outline)
-            
-            # Scatter plot of true centers
-            ax.scatter(x + i*IMG_X, y, color='r', marker='x', linewidth='1')
-        #plt.imshow(np.transpose(a, (2,0,1)))
-        ax.set_aspect('equal', 'box')
-        plt.show()
+        # labels are (y, x, degrees); drawn headless, no figure window
+        truth = render.xy_radians(coords.cpu().numpy(), yx=True, degrees=True)
+        predicted = render.xy_radians(outputs.cpu().numpy(), yx=True,
+                                      degrees=True)
+        tiles = render.overlay(images[:, 0].byte().cpu().numpy(), truth,
+                               predicted, l=block_l, w=block_w)
+        Image.fromarray(render.contact_sheet(tiles, cols=5)).save(results_file)
+        print('Wrote %s' % results_file)
 
 
 def main():
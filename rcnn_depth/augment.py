@@ -0,0 +1,183 @@
+# Batch augmentation
+# Random rotations, shifts and flips of a whole collated batch in one
+# affine_grid / grid_sample call, on whatever device the batch is on, with
+# the block coords moved along; then sensor noise and dropped (zero) depth
+# pixels. Every epoch sees new images without rendering or storing any.
+# WindowBatches wraps a loader of (image, coords) batches and recomputes the
+# sliding window labels of the augmented batch, so the training loops get
+# (images, labels, cropCoords) like from a window dataset.
+#
+# augment = BatchAugment(shift=20, flip=True, noise=0.01, dropout=0.01)
+# train_loader = WindowBatches(make_loader(PackedDepthDataset("train.rects")),
+#                              augment)
+# for images, labels, cropCoords in train_loader:
+#     ...
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+import windows
+
+
+class BatchAugment(object):
+    def __init__(self, rotate=math.pi, shift=0.0, flip=False, noise=0.0,
+                 dropout=0.0, keep_in=windows.MARGIN_PX, padding="border",
+                 seed=None):
+        """
+        : param rotate: rotations drawn from [-rotate, rotate] radians,
+            about the image center
+        : param shift: shifts drawn from [-shift, shift] pixels, in x and y
+        : param flip: mirror half the images left to right
+        : param noise: std of gaussian noise added to every pixel, in the
+            images' own units (uint8 images: 0..255)
+        : param dropout: fraction of pixels set to 0, like missing depth
+            readings
+        : param keep_in: shifts are clamped so block centers stay this many
+            pixels inside the image (when they can)
+        : param padding: grid_sample padding for pixels coming from outside
+            the image; "border" continues the table, "zeros" for binary
+            images
+        : param seed: seeds the random draws, per device
+        """
+        self.rotate = rotate
+        self.shift = shift
+        self.flip = flip
+        self.noise = noise
+        self.dropout = dropout
+        self.keep_in = keep_in
+        self.padding = padding
+        self.seed = seed
+        self._generators = {}
+
+    def _generator(self, device):
+        if self.seed is None:
+            return None
+        if device not in self._generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self._generators[device] = generator
+        return self._generators[device]
+
+    def _rand(self, *size, device, generator):
+        return torch.rand(*size, device=device, generator=generator)
+
+    def __call__(self, images, coords):
+        """
+        : param images: (N, H, W) or (N, C, H, W) tensor, any dtype
+        : param coords: (N, 3) as (x, y, theta), or (N, R, 3) for scenes with
+            several blocks
+        : return: augmented images (same shape and dtype) and their coords
+        """
+        device = images.device
+        generator = self._generator(device)
+        dtype = images.dtype
+        squeeze = images.dim() == 3
+        x = images.float()
+        if squeeze:
+            x = x.unsqueeze(1)
+        num, _, h, w = x.shape
+        coords = coords.to(device=device, dtype=torch.float32)
+        points = coords.reshape(num, -1, 3)
+
+        angles = (self._rand(num, device=device, generator=generator) * 2 -
+                  1) * self.rotate
+        signs = torch.ones(num, device=device)
+        if self.flip:
+            flips = self._rand(num, device=device, generator=generator) < 0.5
+            signs[flips] = -1.0
+        shifts = (self._rand(num, 2, device=device, generator=generator) * 2 -
+                  1) * self.shift
+
+        # forward map, pixel offsets from the center: q = R(angle) F p + t,
+        # F mirrors x
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        rf = torch.stack((torch.stack((cos * signs, -sin), -1),
+                          torch.stack((sin * signs, cos), -1)), 1)
+        center = torch.tensor([(w - 1) / 2.0, (h - 1) / 2.0], device=device)
+        moved = (points[..., :2] - center) @ rf.transpose(1, 2)
+
+        # clamp the shifts so every block center stays keep_in inside
+        low = self.keep_in - center - moved.min(dim=1).values
+        high = (center - self.keep_in) - moved.max(dim=1).values
+        shifts = torch.maximum(torch.minimum(shifts, high), low)
+
+        newCoords = torch.empty_like(points)
+        newCoords[..., :2] = moved + center + shifts[:, None]
+        # blocks look the same turned by 180 degrees, labels are in [0, pi)
+        newCoords[..., 2] = torch.remainder(
+            signs[:, None] * points[..., 2] + angles[:, None], math.pi)
+
+        # grid_sample wants the inverse map, output to input, in [-1, 1]
+        # coords: p = (R F)^-1 (q - t), and (R F)^-1 = F R^T
+        inverse = torch.stack((torch.stack((cos * signs, sin * signs), -1),
+                               torch.stack((-sin, cos), -1)), 1)
+        scale = torch.tensor([2.0 / w, 2.0 / h], device=device)
+        theta = torch.empty(num, 2, 3, device=device)
+        theta[:, :, :2] = inverse * scale[:, None] / scale
+        theta[:, :, 2] = -(inverse @ shifts[:, :, None])[..., 0] * scale
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        x = F.grid_sample(x, grid, mode="bilinear",
+                          padding_mode=self.padding, align_corners=False)
+
+        if self.noise:
+            x = x + self.noise * torch.randn(x.shape, device=device,
+                                             generator=generator)
+        if self.dropout:
+            dropped = self._rand(num, 1, h, w, device=device,
+                                 generator=generator) < self.dropout
+            x = x.masked_fill(dropped, 0.0)
+
+        if squeeze:
+            x = x.squeeze(1)
+        if dtype == torch.uint8:
+            x = x.round().clamp(0, 255)
+        return x.to(dtype), newCoords.reshape(coords.shape)
+
+
+class WindowBatches(object):
+    """
+    Augmented batches of a loader of (images, coords) batches, with window
+    labels made for the augmented coords
+    """
+
+    def __init__(self, loader, augment, windowSize=windows.WINDOWSIZE,
+                 stepSize=windows.STEPSIZE, margin=windows.MARGIN_PX,
+                 device=None):
+        """
+        : param windowSize: None to yield (images, coords), for models that
+            regress the coords of the whole image
+        : param device: move batches here before augmenting (the training
+            loop's .to(device) is then free)
+        """
+        self.loader = loader
+        self.augment = augment
+        self.windowSize = windowSize
+        self.stepSize = stepSize
+        self.margin = margin
+        self.device = device
+        self._grids = {}
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for images, coords in self.loader:
+            if self.device is not None:
+                images = images.to(self.device, non_blocking=True)
+                coords = coords.to(self.device, non_blocking=True)
+            images, coords = self.augment(images, coords)
+            if self.windowSize is None:
+                yield images, coords
+                continue
+            imgShape = tuple(images.shape[-2:])
+            if imgShape not in self._grids:
+                self._grids[imgShape] = windows.windowGrid(
+                    imgShape, self.windowSize, self.stepSize)
+            hasRects, rectCoords = windows.labelWindows(
+                coords.cpu().numpy(), self._grids[imgShape], self.windowSize,
+                self.margin)
+            yield (images,
+                   torch.from_numpy(hasRects).float().to(images.device),
+                   torch.from_numpy(rectCoords).to(images.device))
@@ -0,0 +1,304 @@
+# Throughput benchmarks for the rcnn_depth pipeline
+# Every result is one json line (images/sec, per phase seconds, peak RSS), so
+# runs can be diffed or appended to a log and compared over time.
+#
+# python bench.py train --models Net classifNet regrNet --batch-sizes 8 32
+# python bench.py train --models classifNet --workers 0 2 4  # loader bound?
+# python bench.py train --models classifNet --fast  # bf16 / channels last
+# python bench.py train --models classifNet --channels 6,16 12,32 4,8,16 \
+#     --hidden 120,84 64  # model size vs throughput
+# python bench.py pyramid --out bench.jsonl
+# python bench.py imports  # seconds to import each module / script
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from rectgen import IMG_X, IMG_Y, make_batch
+from rectdata import create_packed, make_loader, PackedDepthDataset
+import models
+from models import (Net, classifNet, regrNet, fcnClassifNet, cropRegrNet,
+                    multiTaskNet, MultiObjLoss)
+from detect import detectPyramid
+import fastcpu
+from instrument import PhaseTimer
+import windows
+
+MODELS = ("Net", "classifNet", "regrNet", "multiTaskNet")
+IMPORTS = ("rectgen", "rectdata", "windows", "models", "detect", "train",
+           "evaluate", "export", "attempt2.py", "v5_Sliding Window.py")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, bytes on macs
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / (1024.0 * 1024.0)
+    return rss / 1024.0
+
+
+def _timeit(fxn, repeats):
+    fxn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fxn()
+    return (time.perf_counter() - start) / repeats
+
+
+def _make_model(modelName, img_size, **layers):
+    # layers: channels / hidden config, see models.convLayers
+    if modelName == "Net":
+        return Net(img_size, img_size, **layers)
+    if modelName == "classifNet":
+        return classifNet(img_size, img_size, **layers)
+    if modelName == "regrNet":
+        return regrNet(windows.WINDOWSIZE, 3, img_size, img_size, **layers)
+    if modelName == "multiTaskNet":
+        return multiTaskNet(img_size, img_size, **layers)
+    raise ValueError("unknown model %s" % modelName)
+
+
+def _parseWidths(text):
+    return tuple(int(width) for width in text.split(","))
+
+
+def bench_train(modelName, batch_size=15, img_size=IMG_X, threads=1,
+                steps=10, workers=0, pin_memory=False, fast=False,
+                channels=models.CHANNELS, hidden=models.HIDDEN):
+    """
+    One config: time data loading, crop extraction, forward, backward and
+    optimizer step separately over `steps` training batches. "load" is the
+    time spent waiting for the loader, so with workers the result also says
+    whether training is loader bound or compute bound. Only regrNet takes
+    crops, crop_s is null (n/a) for the others. fast trains with
+    bf16 autocast, channels last and fused Adam (fastcpu.py). channels and
+    hidden set the conv and fc layer widths (and depth).
+    """
+    torch.set_num_threads(threads)
+    torch.manual_seed(0)
+    model = _make_model(modelName, img_size, channels=channels,
+                        hidden=hidden)
+    numParams = sum(p.numel() for p in model.parameters())
+    model = fastcpu.prepare(model, fast)
+    optimizer = fastcpu.make_optimizer(model.parameters(), lr=0.001,
+                                       fused=fast)
+    if modelName == "classifNet":
+        criterion = nn.BCELoss()
+    elif modelName == "multiTaskNet":
+        criterion = MultiObjLoss()
+    else:
+        criterion = nn.MSELoss()
+
+    timer = PhaseTimer()
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.rects")
+        create_packed(filename, batch_size * (steps + 1), img_size, img_size,
+                      rng=np.random.RandomState(0))
+        # Net regresses one (x, y, theta) per image, the others per window
+        windowSize = None if modelName == "Net" else windows.WINDOWSIZE
+        dataset = PackedDepthDataset(filename, windowSize=windowSize)
+        loader = make_loader(dataset, batch_size=batch_size,
+                             workers=workers, pin_memory=pin_memory, seed=0)
+        batches = iter(loader)
+
+        for i_batch in range(steps + 1):
+            if i_batch == 1:
+                # first batch is warm up
+                timer = PhaseTimer()
+            timer.start("load")
+            sample = next(batches)
+            images = sample[0].float() / 255
+            timer.stop()
+
+            if modelName == "regrNet":
+                # the other models crop (or don't) inside forward
+                timer.start("crop")
+                crops = windows.makeCrops(images)
+                timer.stop()
+
+            timer.start("forward")
+            with fastcpu.autocast(fast):
+                if modelName == "Net":
+                    outputs = model(fastcpu.to_layout(
+                        images[:, None].expand(-1, 3, -1, -1), fast))
+                    target = sample[1]
+                elif modelName == "classifNet":
+                    outputs, _ = model(images)
+                    target = sample[1]
+                elif modelName == "multiTaskNet":
+                    outputs = None
+                    loss, _, _ = criterion(*model(images), sample[1],
+                                           sample[2])
+                else:
+                    outputs = model(fastcpu.to_layout(crops, fast),
+                                    sample[1])
+                    target = sample[2]
+            if outputs is not None:
+                loss = criterion(outputs.float(), target)
+            timer.stop()
+
+            timer.start("backward")
+            optimizer.zero_grad()
+            loss.backward()
+            timer.stop()
+
+            timer.start("step")
+            optimizer.step()
+            timer.stop()
+
+    total = sum(timer.seconds.values())
+    load = timer.seconds["load"]
+    result = {"bench": "train", "model": modelName,
+              "batch_size": batch_size, "img_size": img_size,
+              "threads": threads, "workers": workers,
+              "pin_memory": pin_memory, "fast": fast, "steps": steps,
+              "channels": list(channels), "hidden": list(hidden),
+              "params": numParams,
+              "images_per_sec": batch_size * steps / total,
+              "load_frac": load / total,
+              "bound": "loader" if load > total - load else "compute",
+              "peak_rss_mb": peak_rss_mb()}
+    result["crop_s"] = None  # n/a
+    for phase, seconds in timer.seconds.items():
+        result[phase + "_s"] = seconds / steps
+    return result
+
+
+def bench_pyramid(batch_size=16, maxScales=4, repeats=5, threshold=0.5):
+    """
+    Images / sec of multi scale detection, for 1 .. maxScales pyramid levels
+    (scales 1, 0.75, 0.5, ...)
+    """
+    images, _ = make_batch(batch_size, IMG_X, IMG_Y, num_rects=3,
+                           rng=np.random.RandomState(0))
+    images = torch.from_numpy(images).float() / 255
+    classifModel = fcnClassifNet().eval()
+    regrModel = cropRegrNet().eval()
+
+    results = []
+    for numScales in range(1, maxScales + 1):
+        scales = tuple(1.0 - 0.25 * i for i in range(numScales))
+        seconds = _timeit(lambda: detectPyramid(images, classifModel,
+                                                regrModel, scales, threshold),
+                          repeats)
+        results.append({"bench": "pyramid", "scales": numScales,
+                        "batch_size": batch_size,
+                        "images_per_sec": batch_size / seconds,
+                        "peak_rss_mb": peak_rss_mb()})
+    return results
+
+
+def bench_import(target, repeats=5):
+    """
+    Seconds to import a module (or load a script without running its main)
+    in a fresh interpreter, minus the bare interpreter startup; the best of
+    repeats, since the first run also warms the file cache
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    if target.endswith(".py"):
+        stmt = "import runpy; runpy.run_path(%r, run_name='bench')" % (
+            os.path.join(here, target))
+    else:
+        stmt = "import %s" % target
+
+    def _run(code):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-c", code], cwd=here,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        return time.perf_counter() - start, proc
+
+    baseline = min(_run("pass")[0] for _ in range(repeats))
+    seconds, error = [], None
+    for _ in range(repeats):
+        elapsed, proc = _run(stmt)
+        if proc.returncode:
+            error = proc.stderr.decode().strip().splitlines()[-1]
+            break
+        seconds.append(elapsed)
+    result = {"bench": "import", "target": target}
+    if error:
+        result["error"] = error
+    else:
+        result["import_s"] = min(seconds) - baseline
+    return result
+
+
+def run_isolated(fxn, *args, **kwargs):
+    """
+    Run one benchmark in a fresh process, so peak RSS and thread settings
+    belong to that config alone
+    """
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(fxn, *args, **kwargs).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="rcnn_depth throughput benchmarks")
+    parser.add_argument("bench", choices=["train", "pyramid", "imports"])
+    parser.add_argument("--models", nargs="+", default=list(MODELS),
+                        choices=MODELS)
+    parser.add_argument("--imports", nargs="+", default=list(IMPORTS),
+                        help="modules or scripts for the imports bench")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[15])
+    parser.add_argument("--img-sizes", nargs="+", type=int, default=[IMG_X])
+    parser.add_argument("--threads", nargs="+", type=int,
+                        default=[torch.get_num_threads()])
+    parser.add_argument("--workers", nargs="+", type=int, default=[0])
+    parser.add_argument("--pin-memory", action="store_true")
+    parser.add_argument("--fast", action="store_true",
+                        help="bf16 autocast, channels last, fused Adam")
+    parser.add_argument("--channels", nargs="+", type=_parseWidths,
+                        default=[models.CHANNELS],
+                        help="conv widths per model config, e.g. 6,16 8,16,32")
+    parser.add_argument("--hidden", nargs="+", type=_parseWidths,
+                        default=[models.HIDDEN],
+                        help="fc widths per model config, e.g. 120,84 64")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--out", help="append json lines here, not stdout")
+    args = parser.parse_args()
+
+    results = []
+    if args.bench == "train":
+        for modelName in args.models:
+            for img_size in args.img_sizes:
+                for batch_size in args.batch_sizes:
+                    for threads in args.threads:
+                        for workers in args.workers:
+                            for channels in args.channels:
+                                for hidden in args.hidden:
+                                    results.append(run_isolated(
+                                        bench_train, modelName, batch_size,
+                                        img_size, threads, args.steps,
+                                        workers, args.pin_memory, args.fast,
+                                        channels, hidden))
+    elif args.bench == "pyramid":
+        for batch_size in args.batch_sizes:
+            results.extend(bench_pyramid(batch_size, repeats=args.repeats))
+    elif args.bench == "imports":
+        for target in args.imports:
+            results.append(bench_import(target, args.repeats))
+
+    out = open(args.out, "a") if args.out else sys.stdout
+    for result in results:
+        out.write(json.dumps(result) + "\n")
+    if args.out:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+# Resumable checkpoints
+# Model and optimizer state_dicts (not pickled objects) are copied to cpu on
+# the training thread, then written by a background thread to a temp file
+# that is renamed into place, so a crash never leaves a half written
+# checkpoint and training doesn't wait on the disk. The last `keep`
+# checkpoints are kept, plus a copy of the best one.
+#
+# checkpoints = CheckpointManager(".", "checkpoint_attempt2")
+# state = checkpoints.resume({"regrModel": model}, {"optimizer": optimizer})
+# start_epoch = state["epoch"] + 1 if state else 0
+# ...
+# checkpoints.save(epoch, {"regrModel": model}, {"optimizer": optimizer},
+#                  is_best=is_best, best_loss=best_loss)
+# checkpoints.close()
+
+import concurrent.futures
+import glob
+import os
+import re
+import shutil
+
+import torch
+
+SUFFIX = ".pth.tar"
+
+
+def _snapshot(obj):
+    """
+    Copy of a (nested) state_dict with every tensor detached and on cpu, so
+    training can keep updating the originals while it is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
+def _atomic_save(state, filename):
+    tmp = filename + ".tmp"
+    torch.save(state, tmp)
+    os.replace(tmp, filename)
+
+
+class CheckpointManager(object):
+    """
+    Checkpoints <directory>/<prefix>_e<epoch>.pth.tar, one per epoch, and
+    <directory>/BEST_<prefix>.pth.tar
+    """
+
+    def __init__(self, directory=".", prefix="checkpoint", keep=3,
+                 background=True):
+        if keep < 1:
+            raise ValueError("keep must be at least 1, got %r" % keep)
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # one writer thread: checkpoints land on disk in order
+        self._pool = (concurrent.futures.ThreadPoolExecutor(1)
+                      if background else None)
+        self._pending = []
+
+    @property
+    def best(self):
+        return os.path.join(self.directory,
+                            "BEST_" + self.prefix + SUFFIX)
+
+    def filename(self, epoch):
+        return os.path.join(self.directory,
+                            "%s_e%04d%s" % (self.prefix, epoch, SUFFIX))
+
+    def checkpoints(self):
+        """
+        Existing checkpoints, oldest first
+        """
+        pattern = re.compile(re.escape(self.prefix) + r"_e(\d+)" +
+                             re.escape(SUFFIX) + "$")
+        found = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory),
+                                           self.prefix + "_e*" + SUFFIX)):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), path))
+        return [path for _, path in sorted(found)]
+
+    def save(self, epoch, models, optimizers=None, is_best=False, **extra):
+        """
+        Checkpoint at the end of an epoch; resuming starts the next one
+        : param models, optimizers: dicts of name -> module / optimizer
+        : param extra: anything else to restore (best_loss, loss history, ..),
+            plain python values or tensors
+        """
+        state = {
+            "epoch": epoch,
+            "models": {name: model.state_dict()
+                       for name, model in models.items()},
+            "optimizers": {name: optimizer.state_dict()
+                           for name, optimizer in (optimizers or {}).items()},
+        }
+        state.update(extra)
+        state = _snapshot(state)
+        filename = self.filename(epoch)
+
+        self._reap()
+        if self._pool is None:
+            self._write(state, filename, is_best)
+        else:
+            self._pending.append(self._pool.submit(self._write, state,
+                                                   filename, is_best))
+        return filename
+
+    def _write(self, state, filename, is_best):
+        _atomic_save(state, filename)
+        if is_best:
+            # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
+            tmp = self.best + ".tmp"
+            shutil.copyfile(filename, tmp)
+            os.replace(tmp, self.best)
+        for old in self.checkpoints()[:-self.keep]:
+            os.remove(old)
+
+    def _reap(self):
+        # surface errors from earlier writes instead of losing them
+        done = [f for f in self._pending if f.done()]
+        self._pending = [f for f in self._pending if not f.done()]
+        for future in done:
+            future.result()
+
+    def wait(self):
+        """
+        Block until every checkpoint handed to save is on disk
+        """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        self.wait()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def load(self, filename=None, map_location="cpu"):
+        """
+        : return: a checkpoint's state dict (latest when filename is None),
+            None when there isn't one
+        """
+        self.wait()
+        if filename is None:
+            existing = self.checkpoints()
+            if not existing:
+                return None
+            filename = existing[-1]
+        return torch.load(filename, map_location=map_location,
+                          weights_only=True)
+
+    def resume(self, models, optimizers=None, filename=None,
+               map_location="cpu"):
+        """
+        Load the latest (or given) checkpoint into models and optimizers
+        : return: the checkpoint (epoch and the extras passed to save),
+            or None when starting fresh
+        """
+        state = self.load(filename, map_location)
+        if state is None:
+            return None
+        for name, model in models.items():
+            model.load_state_dict(state["models"][name])
+        for name, optimizer in (optimizers or {}).items():
+            optimizer.load_state_dict(state["optimizers"][name])
+        return state
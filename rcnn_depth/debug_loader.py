@@ -1,6 +1,5 @@
 # https://conorsdatablog.wordpress.com/2018/05/03/up-and-running-with-pytorch-minibatching-dataloading-and-model-building/
 
-import pandas as pd
 from sklearn.datasets import make_moons
 import torch
 from torch.autograd import Variable
@@ -11,6 +10,8 @@ import numpy as np
 from torch.utils.data import Dataset, DataLoader
 import torch.nn.functional as F
 
+from instrument import make_sink
+
 torch.__version__
 
 
@@ -96,4 +97,8 @@ for e in range(num_epochs):
         num_epochs, np.round(loss.data[0], 3), np.round(acc.data[0], 3)))
 
 
-pd.DataFrame(dict(losses=losses, acc=accs)).to_csv("Data/model_performance.csv")
+# one row per batch, appended so runs can be compared
+sink = make_sink("Data/model_performance_steps.csv")
+for step, (loss, acc) in enumerate(zip(losses, accs)):
+    sink.write({"step": step, "losses": float(loss), "acc": float(acc)})
+sink.close()
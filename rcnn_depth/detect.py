@@ -0,0 +1,214 @@
+# Sliding window detection
+# Two stage inference: classify every window, then regress (x, y, theta) only
+# for the windows that contain a block. Overlapping windows see the same
+# block, so their detections are merged with rotated box NMS.
+
+import torch
+import torch.nn.functional as F
+
+from rectgen import block_l, block_w
+import windows
+
+
+def windowScores(classifModel, images):
+    """
+    (N, numCrops) window probabilities from classifNet or fcnClassifNet
+    """
+    out = classifModel(images)
+    # classifNet also hands back its crops
+    return out[0] if isinstance(out, tuple) else out
+
+
+def detect(images, classifModel, regrModel, threshold=0.5, windowMask=None):
+    """
+    Batched inference with early exit. Windows above threshold are gathered
+    into one compact batch for regrModel (a cropRegrNet), and the results are
+    scattered back, so regression cost follows the number of detections and
+    everything stays on the models' device. The classifNet / regrNet pair
+    the training scripts train works too: regrNet sees all windows of the
+    images with a detection, scaled by their scores like in train.train.
+    : param images: (N, IMG_Y, IMG_X) depth images
+    : param windowMask: optional (N, numCrops) bool, windows to consider
+    : return: containsObj (N, numCrops), objCoords (N, numCrops, 3) as
+        (x, y, theta) in image pixels, zeros for windows without a block
+    """
+    cropSize, stepSize = classifModel.cropSize, classifModel.step
+    device = next(classifModel.parameters()).device
+
+    with torch.no_grad():
+        images = images.to(device).float()
+        if images.dim() == 4:
+            images = images.squeeze(1)
+        containsObj = windowScores(classifModel, images)
+
+        # (N, ny, nx, h, w) view; only the picked windows get copied
+        view = windows.windowView(images, cropSize, stepSize)
+        nx = view.shape[2]
+        picked = containsObj > threshold
+        if windowMask is not None:
+            picked &= windowMask.to(device)
+        n_idx, k_idx = picked.nonzero(as_tuple=True)
+
+        objCoords = containsObj.new_zeros(containsObj.shape + (3,))
+        if n_idx.numel() and hasattr(regrModel, "numCrops"):
+            # regrNet: crops stacked as channels, image coordinates out
+            hits, n_hit = n_idx.unique(return_inverse=True)
+            crops = windows.makeCrops(images[hits], cropSize, stepSize)
+            preds = regrModel(crops, containsObj[hits])
+            objCoords[n_idx, k_idx] = preds[n_hit, k_idx].to(objCoords.dtype)
+        elif n_idx.numel():
+            crops = view[n_idx, k_idx // nx, k_idx % nx]
+            preds = regrModel(crops)
+
+            # window relative -> image coordinates
+            ys, xs = windows.windowGrid(images.shape[-2:], cropSize, stepSize)
+            xs = torch.as_tensor(xs, dtype=preds.dtype, device=device)
+            ys = torch.as_tensor(ys, dtype=preds.dtype, device=device)
+            preds[:, 0] += xs[k_idx]
+            preds[:, 1] += ys[k_idx]
+            objCoords[n_idx, k_idx] = preds
+
+    return containsObj, objCoords
+
+
+def detectPyramid(images, classifModel, regrModel, scales=(1.0, 0.75, 0.5),
+                  threshold=0.5):
+    """
+    Multi scale detection. The image pyramid is built once per batch, every
+    level is zero padded to a common size and all levels go through detect
+    as one batch; windows that reach into the padding are ignored, and
+    detections are mapped back to original image coordinates.
+    Fixed size models (classifNet, regrNet, with their numCrops) only work
+    when no scale is above 1, so the padded levels keep the image size;
+    fcnClassifNet and cropRegrNet take any scales.
+    : param images: (N, IMG_Y, IMG_X) depth images
+    : return: containsObj (N, len(scales) * numCrops) with windows of the
+        first scale first, objCoords (N, len(scales) * numCrops, 3); both
+        can go straight into decodeDetections
+    """
+    cropSize, stepSize = classifModel.cropSize, classifModel.step
+    device = next(classifModel.parameters()).device
+    images = images.to(device).float()
+    if images.dim() == 4:
+        images = images.squeeze(1)
+    N, img_y, img_x = images.shape
+    sizes = [(int(round(img_y * s)), int(round(img_x * s))) for s in scales]
+    pad_y = max(max(size[0] for size in sizes), cropSize[0])
+    pad_x = max(max(size[1] for size in sizes), cropSize[1])
+    levelCrops = windows.numCrops((pad_y, pad_x), cropSize, stepSize)
+    for model in (classifModel, regrModel):
+        numCrops = getattr(model, "numCrops", None)
+        if numCrops is not None and numCrops != levelCrops:
+            raise ValueError(
+                "%s takes %d windows per image, pyramid levels padded to "
+                "%dx%d have %d; use scales <= 1, fcnClassifNet and "
+                "cropRegrNet" % (type(model).__name__, numCrops, pad_x,
+                                 pad_y, levelCrops))
+
+    levels = []
+    masks = []
+    ys, xs = windows.windowGrid((pad_y, pad_x), cropSize, stepSize)
+    ys = torch.as_tensor(ys, device=device)
+    xs = torch.as_tensor(xs, device=device)
+    for (h, w) in sizes:
+        if (h, w) == (img_y, img_x):
+            level = images
+        else:
+            level = F.interpolate(images[:, None], size=(h, w),
+                                  mode="bilinear", align_corners=False)[:, 0]
+        levels.append(F.pad(level, (0, pad_x - w, 0, pad_y - h)))
+        valid = (ys + cropSize[0] <= h) & (xs + cropSize[1] <= w)
+        masks.append(valid.expand(N, -1))
+
+    # (L * N, ...) in level major order
+    containsObj, objCoords = detect(torch.cat(levels), classifModel,
+                                    regrModel, threshold,
+                                    windowMask=torch.cat(masks))
+    L, K = len(scales), containsObj.shape[1]
+    containsObj = containsObj * torch.cat(masks).to(containsObj.dtype)
+
+    # back to original pixels; theta does not change with scale
+    scale = torch.tensor([[s, s, 1.0] for s in scales], device=device,
+                         dtype=objCoords.dtype)
+    objCoords = objCoords.view(L, N, K, 3) / scale[:, None, None, :]
+
+    containsObj = containsObj.view(L, N, K).permute(1, 0, 2).reshape(N, L * K)
+    objCoords = objCoords.permute(1, 0, 2, 3).reshape(N, L * K, 3)
+    return containsObj, objCoords
+
+
+# -- Merge detections -------------------------------------------------------
+
+def rotatedIoU(boxesA, boxesB, l=block_l, w=block_w, samples=8):
+    """
+    IoU of every pair of (x, y, theta) rectangles of size l x w (the
+    rectangles makeRectangle builds), for all pairs at once. The overlap is
+    estimated from a samples x samples grid of points inside each box of A
+    that are tested against every box of B.
+    : return: (len(boxesA), len(boxesB))
+    """
+    steps = (torch.arange(samples, dtype=boxesA.dtype,
+                          device=boxesA.device) + 0.5) / samples - 0.5
+    u = (steps[:, None] * l).expand(samples, samples).reshape(-1)
+    v = (steps[None, :] * w).expand(samples, samples).reshape(-1)
+
+    # sample points of A in image coordinates, (NA, S)
+    cA, sA = torch.cos(boxesA[:, 2:3]), torch.sin(boxesA[:, 2:3])
+    px = cA * u - sA * v + boxesA[:, 0:1]
+    py = sA * u + cA * v + boxesA[:, 1:2]
+
+    # into the frame of every box of B, (NA, NB, S)
+    cB = torch.cos(boxesB[:, 2])[None, :, None]
+    sB = torch.sin(boxesB[:, 2])[None, :, None]
+    dx = px[:, None, :] - boxesB[None, :, 0, None]
+    dy = py[:, None, :] - boxesB[None, :, 1, None]
+    inside = (torch.abs(cB * dx + sB * dy) <= l / 2.0)
+    inside &= (torch.abs(cB * dy - sB * dx) <= w / 2.0)
+
+    # all boxes have the same area, so IoU only depends on the overlap
+    overlap = inside.to(boxesA.dtype).mean(-1)
+    return overlap / (2 - overlap)
+
+
+def nms(boxes, scores, iouThreshold=0.3, imageIdx=None, l=block_l,
+        w=block_w):
+    """
+    Greedy non-maximum suppression over rotated boxes, vectorized: the IoU
+    matrix is computed once, then kept boxes are found by iterating
+    "keep a box unless a kept, higher scoring box overlaps it" until nothing
+    changes (a handful of passes, not one per box)
+    : param imageIdx: (M,) image of each box, boxes of different images
+        never suppress each other
+    : return: indices of the kept boxes, highest score first
+    """
+    order = scores.argsort(descending=True)
+    boxes = boxes[order]
+    overlaps = rotatedIoU(boxes, boxes, l, w) > iouThreshold
+    if imageIdx is not None:
+        imageIdx = imageIdx[order]
+        overlaps &= imageIdx[:, None] == imageIdx[None, :]
+    # only higher scoring boxes (earlier in order) can suppress
+    overlaps = torch.triu(overlaps, diagonal=1)
+
+    keep = torch.ones(len(order), dtype=torch.bool, device=boxes.device)
+    for _ in range(len(order)):
+        newKeep = ~(overlaps & keep[:, None]).any(0)
+        if torch.equal(newKeep, keep):
+            break
+        keep = newKeep
+    return order[keep]
+
+
+def decodeDetections(containsObj, objCoords, threshold=0.5, iouThreshold=0.3,
+                     l=block_l, w=block_w):
+    """
+    Turn per window outputs (from detect) into one detection per block
+    : return: dets (M, 4) as (x, y, theta, score), imageIdx (M,) the image of
+        every detection
+    """
+    n_idx, k_idx = (containsObj > threshold).nonzero(as_tuple=True)
+    boxes = objCoords[n_idx, k_idx]
+    scores = containsObj[n_idx, k_idx]
+    keep = nms(boxes, scores, iouThreshold, imageIdx=n_idx, l=l, w=w)
+    dets = torch.cat((boxes[keep], scores[keep, None]), dim=1)
+    return dets, n_idx[keep]
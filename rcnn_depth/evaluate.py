@@ -0,0 +1,205 @@
+# Looking at results
+# evaluate_model runs a grasp regressor over a whole test set in large no_grad
+# batches and grasp_errors / summarize turn its predictions into center
+# error, angle error (blocks look the same rotated by 180 degrees, so errors
+# wrap) and success rates at tolerances, all vectorized. Plots of
+# predictions, sliding window crops and loss curves import matplotlib only
+# when they draw.
+#
+# python evaluate.py regrNet_attempt2.pt --data test.rects --out summary.json
+
+import json
+
+import numpy as np
+import torch
+
+from rectgen import IMG_X, block_l, block_w
+
+CENTER_TOLS = (2.0, 5.0, 10.0)  # pixels
+ANGLE_TOLS = (5.0, 10.0, 15.0)  # degrees
+
+
+# -- Metrics -------------------------------------------------------
+
+
+def _toXYDegrees(coords, yx=False, degrees=False):
+    coords = np.asarray(coords, dtype=np.float64)
+    x, y, orient = coords[:, 0], coords[:, 1], coords[:, 2]
+    if yx:
+        x, y = y, x
+    if not degrees:
+        orient = np.degrees(orient)
+    return x, y, orient
+
+
+def grasp_errors(predicted, truth, yx=False, degrees=False):
+    """
+    : param predicted, truth: (N, 3) as (x, y, orient); (y, x, orient) with
+        yx, orient in degrees with degrees (attempt2's labels are both)
+    : return: center errors in pixels, angle errors in degrees in [0, 90]
+    """
+    px, py, porient = _toXYDegrees(predicted, yx, degrees)
+    tx, ty, torient = _toXYDegrees(truth, yx, degrees)
+    centerErr = np.hypot(px - tx, py - ty)
+    angleErr = np.mod(porient - torient, 180.0)
+    angleErr = np.minimum(angleErr, 180.0 - angleErr)
+    return centerErr, angleErr
+
+
+def summarize(centerErr, angleErr, centerTols=CENTER_TOLS,
+              angleTols=ANGLE_TOLS):
+    """
+    : return: dict of error statistics and success rates; success@c_a is the
+        fraction of predictions within c pixels and a degrees
+    """
+    summary = {"count": int(len(centerErr))}
+    for name, err in (("center_px", centerErr), ("angle_deg", angleErr)):
+        summary[name + "_mean"] = float(np.mean(err))
+        summary[name + "_median"] = float(np.median(err))
+        summary[name + "_p90"] = float(np.percentile(err, 90))
+    # (len(centerTols), len(angleTols), N) in one broadcast
+    success = ((centerErr <= np.asarray(centerTols)[:, None, None]) &
+               (angleErr <= np.asarray(angleTols)[None, :, None]))
+    rates = success.mean(axis=-1)
+    for i, c in enumerate(centerTols):
+        for j, a in enumerate(angleTols):
+            summary["success@%gpx_%gdeg" % (c, a)] = float(rates[i, j])
+    return summary
+
+
+def evaluate_model(model, loader, device="cpu", rgb=False, scale=False):
+    """
+    Predictions for every sample of a loader of (image, coords) batches
+    : param rgb: model wants 3 channel images (Net), gray ones are repeated
+    : param scale: divide uint8 images by 255
+    : return: predicted, truth, both (N, 3) numpy arrays
+    """
+    predicted, truth = [], []
+    with torch.no_grad():
+        for images, coords in loader:
+            images = images.to(device).float()
+            if scale:
+                images = images / 255
+            if rgb and images.dim() == 3:
+                images = images[:, None].expand(-1, 3, -1, -1)
+            predicted.append(model(images).float().cpu())
+            truth.append(coords.float().reshape(len(coords), -1))
+    return torch.cat(predicted).numpy(), torch.cat(truth).numpy()
+
+
+# -- Plots -------------------------------------------------------
+
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def plot_loss_history(loss_history, steps=None):
+    """
+    : param steps: batch index of every loss, for decimated / sampled
+        histories (metrics.LossHistory.steps)
+    """
+    plt = _pyplot()
+    if steps is None:
+        steps = range(len(loss_history))
+    plt.plot(steps, loss_history)  # regr loss
+    plt.show()
+
+
+def plot_predictions(labels, outputs, img_x=IMG_X, l=block_l, w=block_w,
+                     skip_last=10):
+    """
+    True (black) and predicted (orange) blocks of a batch side by side
+    : param labels, outputs: (N, 3) as (x, y, orient in radians)
+    """
+    plt = _pyplot()
+    import matplotlib.patches as patches
+
+    labels = np.asarray(labels)
+    outputs = np.asarray(outputs)
+
+    plt.rcParams['figure.figsize'] = [50, 10]
+
+    fig, ax = plt.subplots()
+
+    for i in range(len(labels) - skip_last):
+        x, y, orient = labels[i]
+        pred_x, pred_y, orientation_pred = outputs[i]
+
+        orient = np.rad2deg(orient)
+        orientation_pred = np.rad2deg(orientation_pred)
+
+        truth_rect = patches.Rectangle((x + i * img_x, y), w, l, angle=orient,
+                                       fill=True, color='black')
+        pred_rect = patches.Rectangle((pred_x + i * img_x, pred_y), w, l,
+                                      angle=orientation_pred, fill=True,
+                                      color='orange')
+        image_outline = patches.Rectangle((i * img_x, 0), img_x, img_x,
+                                          angle=0, fill=False, color='black')
+
+        ax.add_patch(truth_rect)
+        ax.add_patch(pred_rect)
+        ax.add_patch(image_outline)
+
+        # Scatter plot of true centers
+        ax.scatter(x + i * img_x, y, color='r', marker='x', linewidth=1)
+    ax.set_aspect('equal', 'box')
+    plt.show()
+
+
+def show_crops(image, crops):
+    """
+    Original image, then every sliding window crop in its own figure
+    """
+    plt = _pyplot()
+    plt.imshow(image)
+
+    for (i, crop) in enumerate(crops):
+        plt.figure()
+        plt.suptitle("numero: %d" % (i))
+        plt.imshow(crop)
+    plt.show()
+
+
+def main():
+    import argparse
+    import export
+    from rectdata import PackedDepthDataset, make_loader
+
+    parser = argparse.ArgumentParser(
+        description="evaluate an exported grasp regressor on a test set")
+    parser.add_argument("model", help="export.py TorchScript file")
+    parser.add_argument("--data", required=True, help="packed test set")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--out", help="write the summary json here")
+    args = parser.parse_args()
+
+    model, metadata = export.load_model(args.model)
+    # how the model was trained: input channels / scaling, label convention
+    # (attempt2 exports say rgb, yx and degrees)
+    loader = make_loader(PackedDepthDataset(args.data),
+                         batch_size=args.batch_size, workers=args.workers,
+                         shuffle=False)
+    predicted, truth = evaluate_model(model, loader,
+                                      rgb=metadata.get("rgb", False),
+                                      scale=metadata.get("scale", False))
+    # packed datasets are (x, y, radians); the model's outputs follow its
+    # own training labels
+    if metadata.get("yx", False):
+        predicted = predicted[:, [1, 0, 2]]
+    if metadata.get("degrees", False):
+        predicted[:, 2] = np.radians(predicted[:, 2])
+    summary = summarize(*grasp_errors(predicted, truth))
+    summary["model"] = args.model
+    summary["data"] = args.data
+
+    print(json.dumps(summary, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
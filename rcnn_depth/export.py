@@ -0,0 +1,144 @@
+# Inference artifacts
+# export_model writes a frozen TorchScript file (scripted, or traced from an
+# example input when a model can't be scripted) with a small json blob of
+# metadata. load_model only needs torch, so serving code never imports the
+# training scripts or their matplotlib / seaborn / cv2 imports.
+#
+# python export.py checkpoint_attempt2_e0049.pth.tar out.pt --model Net
+
+import json
+import pickle
+import types
+
+import torch
+
+METADATA = "metadata.json"
+
+
+def export_model(model, filename, example=None, metadata=None):
+    """
+    Script (or trace) model in eval mode, freeze it and save it
+    : param example: example input(s), a tensor or a tuple of tensors; needed
+        to trace models torch.jit.script can't handle (classifNet,
+        multiTaskNet: windows.makeCrops); traced models only take images of
+        the example's size
+    : param metadata: json serializable dict stored with the model, e.g. the
+        image size it was trained on
+    : return: the frozen module
+    """
+    model = model.eval()
+    try:
+        scripted = torch.jit.script(model)
+    except Exception:
+        if example is None:
+            raise
+        if not isinstance(example, tuple):
+            example = (example,)
+        with torch.no_grad():
+            scripted = torch.jit.trace(model, example)
+    frozen = torch.jit.freeze(scripted)
+
+    info = {"model": type(model).__name__}
+    info.update(metadata or {})
+    torch.jit.save(frozen, filename,
+                   _extra_files={METADATA: json.dumps(info)})
+    return frozen
+
+
+def load_model(filename, device="cpu"):
+    """
+    : return: the frozen module, ready for inference, and its metadata dict
+    """
+    extra = {METADATA: ""}
+    model = torch.jit.load(filename, map_location=device, _extra_files=extra)
+    metadata = json.loads(extra[METADATA]) if extra[METADATA] else {}
+    return model.eval(), metadata
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # old checkpoints pickled whole models, defined in the training scripts,
+    # so as __main__.Net / classifNet / regrNet; models.py has them now
+    def find_class(self, module, name):
+        if module == "__main__":
+            import models
+            if hasattr(models, name):
+                return getattr(models, name)
+        return super(_LegacyUnpickler, self).find_class(module, name)
+
+
+_legacyPickle = types.SimpleNamespace(Unpickler=_LegacyUnpickler,
+                                      load=pickle.load, __name__="pickle")
+
+
+def _fromLegacy(old):
+    """
+    A fresh models.py model with the weights of an unpickled old one; the
+    old object's attributes are from the old class, only its state_dict is
+    used (old layer names are mapped by models._legacyKeys)
+    """
+    import models
+    name = type(old).__name__
+    if name == "Net":
+        model = models.Net(old._imgx, old._imgy)
+    elif name == "classifNet":
+        model = models.classifNet(old._imgx, old._imgy, old.cropSize,
+                                  old.step)
+    elif name == "regrNet":
+        model = models.regrNet(old.cropSize, old.numOutputs,
+                               stepSize=old.step)
+    else:
+        raise ValueError("don't know how to convert an old %s" % name)
+    model.load_state_dict(old.state_dict())
+    return model
+
+
+def export_checkpoint(checkpointFile, filename, key="regrModel", model=None):
+    """
+    Export a model from a checkpoint.py checkpoint (its state_dict is loaded
+    into model), or from an old style checkpoint of a pickled Net, classifNet
+    or regrNet (the training scripts' checkpoint_attempt2.tar,
+    checkpoint_v2sliding.pth.tar; key "model1" / "model2" for v2sliding)
+    """
+    if model is not None:
+        checkpoint = torch.load(checkpointFile, map_location="cpu",
+                                weights_only=True)
+        model.load_state_dict(checkpoint["models"][key])
+    else:
+        checkpoint = torch.load(checkpointFile, map_location="cpu",
+                                weights_only=False,
+                                pickle_module=_legacyPickle)
+        model = _fromLegacy(checkpoint[key])
+    metadata = {"epoch": checkpoint.get("epoch"),
+                "best_loss": checkpoint.get("best_loss")}
+    if torch.is_tensor(metadata["best_loss"]):
+        metadata["best_loss"] = metadata["best_loss"].item()
+    # for the models that are traced (classifNet, multiTaskNet)
+    from rectgen import IMG_X, IMG_Y
+    example = torch.zeros(1, getattr(model, "_imgy", IMG_Y),
+                          getattr(model, "_imgx", IMG_X))
+    return export_model(model, filename, example, metadata)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="export a checkpointed model to frozen TorchScript")
+    parser.add_argument("checkpoint")
+    parser.add_argument("out")
+    parser.add_argument("--key", default="regrModel")
+    parser.add_argument("--model", choices=["Net", "regrNet", "classifNet"],
+                        help="model class of a state_dict checkpoint; leave "
+                             "out for old checkpoints of pickled models")
+    args = parser.parse_args()
+    # models.py has no side effects
+    import models
+    from rectgen import IMG_X, IMG_Y
+    model = None
+    if args.model == "Net":
+        model = models.Net(IMG_X, IMG_Y)
+    elif args.model == "regrNet":
+        model = models.regrNet((100, 100), 3)
+    elif args.model == "classifNet":
+        model = models.classifNet(IMG_X, IMG_Y)
+    export_checkpoint(args.checkpoint, args.out, args.key, model)
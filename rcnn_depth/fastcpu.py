@@ -0,0 +1,144 @@
+# Opt in fast CPU training
+# bfloat16 autocast, channels last memory format and fused optimizer steps for
+# Net, classifNet and regrNet. Off by default: bf16 trades a little precision
+# for speed, so check_fp32 trains the same seed both ways and compares.
+#
+# python fastcpu.py  # fp32 vs fast check for all three models
+
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from rectgen import IMG_X, IMG_Y, make_batch
+from models import Net, classifNet, regrNet
+import windows
+
+# max relative loss difference check_fp32 accepts (bf16 keeps ~3 digits)
+LOSS_RTOL = 5e-2
+
+
+def prepare(model, channels_last=True):
+    """
+    Model weights in channels last (NHWC) layout, which the CPU conv kernels
+    run fastest with. Returns the model for chaining.
+    """
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def to_layout(x, channels_last=True):
+    # only 4d tensors have a channels last layout
+    if channels_last and x.dim() == 4:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def autocast(bf16=True):
+    """
+    with autocast(): convs and linears run in bfloat16, the rest in float32
+    """
+    return torch.autocast("cpu", dtype=torch.bfloat16, enabled=bf16)
+
+
+def make_optimizer(params, lr=0.001, fused=True):
+    """
+    Adam, with the fused (single kernel) step when fused is set, falling
+    back to the multi tensor step on torch builds without a fused CPU Adam
+    """
+    params = list(params)
+    if not fused:
+        return torch.optim.Adam(params, lr=lr)
+    try:
+        return torch.optim.Adam(params, lr=lr, fused=True)
+    except (RuntimeError, TypeError):
+        return torch.optim.Adam(params, lr=lr, foreach=True)
+
+
+def train_step(model, criterion, optimizer, inputs, targets, bf16=True,
+               channels_last=True):
+    """
+    One optimizer step
+    : param inputs: tuple of model arguments, e.g. (images,) or (crops, labels)
+    : return: loss as a python float
+    """
+    inputs = tuple(to_layout(x, channels_last) for x in inputs)
+    with autocast(bf16):
+        outputs = model(*inputs)
+    if isinstance(outputs, tuple):
+        # classifNet also returns its crops
+        outputs = outputs[0]
+    # losses (BCELoss in particular) are computed in float32
+    loss = criterion(outputs.float(), targets)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+# -- fp32 correctness check -------------------------------------------------
+
+
+def _example(modelName, batch_size, seed):
+    """
+    Model, criterion and one batch of (inputs, targets) for a model name
+    """
+    rng = np.random.RandomState(seed)
+    images, coords = make_batch(batch_size, IMG_X, IMG_Y, rng=rng)
+    images = torch.from_numpy(images).float() / 255
+    grid = windows.windowGrid((IMG_Y, IMG_X))
+    hasRects, rectCoords = windows.labelWindows(coords, grid)
+    hasRects = torch.from_numpy(hasRects).float()
+    rectCoords = torch.from_numpy(rectCoords)
+
+    torch.manual_seed(seed)
+    if modelName == "Net":
+        model = Net(IMG_X, IMG_Y)
+        inputs = (images[:, None].expand(-1, 3, -1, -1),)
+        return model, nn.MSELoss(), inputs, torch.from_numpy(coords).float()
+    if modelName == "classifNet":
+        model = classifNet(IMG_X, IMG_Y)
+        return model, nn.BCELoss(), (images,), hasRects
+    if modelName == "regrNet":
+        model = regrNet(windows.WINDOWSIZE, 3, IMG_X, IMG_Y)
+        inputs = (windows.makeCrops(images), hasRects)
+        return model, nn.MSELoss(), inputs, rectCoords
+    raise ValueError("unknown model %s" % modelName)
+
+
+def check_fp32(modelName, steps=5, batch_size=8, seed=0, lr=0.001,
+               rtol=LOSS_RTOL):
+    """
+    Train the same initial weights on the same batch for a few steps, once in
+    plain float32 and once with bf16 / channels last / fused Adam
+    : return: dict with both loss curves, the max relative loss difference
+        and whether it is within rtol
+    """
+    model, criterion, inputs, targets = _example(modelName, batch_size, seed)
+    fastModel = prepare(copy.deepcopy(model))
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    fastOptimizer = make_optimizer(fastModel.parameters(), lr=lr)
+
+    losses, fastLosses = [], []
+    for _ in range(steps):
+        losses.append(train_step(model, criterion, optimizer, inputs,
+                                 targets, bf16=False, channels_last=False))
+        fastLosses.append(train_step(fastModel, criterion, fastOptimizer,
+                                     inputs, targets))
+
+    losses, fastLosses = np.array(losses), np.array(fastLosses)
+    relDiff = np.abs(fastLosses - losses) / np.maximum(np.abs(losses), 1e-8)
+    return {"model": modelName, "fp32_losses": losses.tolist(),
+            "fast_losses": fastLosses.tolist(),
+            "max_rel_diff": float(relDiff.max()),
+            "ok": bool(relDiff.max() <= rtol)}
+
+
+if __name__ == '__main__':
+    for modelName in ("Net", "classifNet", "regrNet"):
+        result = check_fp32(modelName)
+        print("%-10s max rel loss diff %.4f  %s" % (
+            modelName, result["max_rel_diff"],
+            "ok" if result["ok"] else "MISMATCH"))
@@ -0,0 +1,234 @@
+# Training instrumentation
+# Per phase wall times (load, crop, forward, backward, step) for every batch,
+# written as one record per step to a JSONL or CSV sink, and optionally a
+# torch profiler trace of a window of steps. Records from different runs can
+# be appended to the same file and compared over time.
+#
+# inst = Instrument(make_sink("Data/train_metrics.jsonl", FIELDS), run="v5",
+#                   profile=(10, 5), profile_dir="Data/profile")
+# for images, labels, coords in inst.batches(train_loader):
+#     with inst.phase("forward"):
+#         ...
+#     inst.step(images=len(images), loss=loss.item())
+# inst.close()
+
+import contextlib
+import csv
+import json
+import os
+import time
+
+import torch
+
+# every field of the records train.py writes, the columns of csv sinks;
+# e.g. crop_s only shows up in the regression stage, loss2 in validation
+FIELDS = ("run", "step", "epoch", "stage", "batch_s", "load_s", "crop_s",
+          "forward_s", "backward_s", "step_s", "images", "images_per_sec",
+          "loss", "loss2", "conf_loss", "loc_loss")
+
+
+class PhaseTimer(object):
+    """
+    Accumulates wall time per named phase
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self._phase = None
+        self._start = None
+
+    def start(self, phase):
+        self._phase = phase
+        self._start = time.perf_counter()
+
+    def stop(self):
+        elapsed = time.perf_counter() - self._start
+        self.seconds[self._phase] = (self.seconds.get(self._phase, 0.0) +
+                                     elapsed)
+        self._phase = None
+
+
+# -- Sinks -------------------------------------------------------
+
+
+def _makedirs(filename):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+
+class JsonlSink(object):
+    """
+    One json object per line, appended
+    """
+
+    def __init__(self, filename):
+        _makedirs(filename)
+        self._f = open(filename, "a")
+
+    def write(self, record):
+        self._f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self._f.close()
+
+
+class CsvSink(object):
+    """
+    Appended csv rows with fixed columns: fieldnames, or else the first
+    record's keys. Fields a record doesn't have are left blank, fields that
+    aren't columns are refused rather than dropped, and so is appending to a
+    file whose header has other columns.
+    """
+
+    def __init__(self, filename, fieldnames=None):
+        _makedirs(filename)
+        self.filename = filename
+        self._header = None
+        if os.path.exists(filename) and os.path.getsize(filename):
+            with open(filename) as f:
+                self._header = next(csv.reader(f))
+        self._f = open(filename, "a", newline="")
+        self._writer = None
+        if fieldnames is not None:
+            self._open(list(fieldnames))
+
+    def _open(self, fieldnames):
+        if self._header is not None and self._header != fieldnames:
+            self._f.close()
+            raise ValueError(
+                "%s has columns %s, records have %s; write to a new file"
+                % (self.filename, self._header, fieldnames))
+        self._writer = csv.DictWriter(self._f, fieldnames)
+        if self._header is None:
+            self._writer.writeheader()
+
+    def write(self, record):
+        if self._writer is None:
+            self._open(list(record))
+        unknown = set(record) - set(self._writer.fieldnames)
+        if unknown:
+            raise ValueError("%s has no columns %s" % (
+                self.filename, sorted(unknown)))
+        self._writer.writerow(record)
+
+    def close(self):
+        self._f.close()
+
+
+def make_sink(filename, fieldnames=None):
+    """
+    JsonlSink or CsvSink, by file extension; None for no filename
+    : param fieldnames: csv columns, FIELDS for Instrument records
+    """
+    if not filename:
+        return None
+    if filename.endswith(".csv"):
+        return CsvSink(filename, fieldnames)
+    return JsonlSink(filename)
+
+
+# -- Instrument -------------------------------------------------------
+
+
+class Instrument(object):
+    def __init__(self, sink=None, run=None, profile=None,
+                 profile_dir="profile", sync=False):
+        """
+        : param sink: JsonlSink / CsvSink (make_sink), or None to only keep
+            the running totals
+        : param run: name stored in every record, to tell runs apart
+        : param profile: (first step, number of steps) to capture with the
+            torch profiler, written as a chrome trace to profile_dir
+        : param sync: wait for cuda at the end of every phase, so phase times
+            are real rather than kernel launch times
+        """
+        self.sink = sink
+        self.run = run if run is not None else time.strftime("%Y%m%d-%H%M%S")
+        self.sync = sync and torch.cuda.is_available()
+        self.context = {}
+        self.steps = 0
+        self.totals = {}
+        self._timer = PhaseTimer()
+        self._stepStart = time.perf_counter()
+
+        self._profiler = None
+        if profile is not None:
+            first, num = profile
+            if not os.path.exists(profile_dir):
+                os.makedirs(profile_dir)
+            trace = os.path.join(profile_dir, "trace_%s.json" % self.run)
+            self._profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(
+                    wait=max(first - 1, 0), warmup=min(first, 1),
+                    active=num, repeat=1),
+                on_trace_ready=lambda prof: prof.export_chrome_trace(trace),
+                record_shapes=True)
+            self._profiler.start()
+
+    def set(self, **context):
+        """
+        Fields added to every following record, e.g. epoch or pass name
+        """
+        self.context.update(context)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._timer.start(name)
+        if self._profiler is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self._timer.stop()
+
+    def batches(self, loader):
+        """
+        Iterate a loader, timing the wait for every batch as "load"
+        """
+        batches = iter(loader)
+        while True:
+            with self.phase("load"):
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    return
+            yield batch
+
+    def step(self, images=None, **fields):
+        """
+        End of one batch: write its record and reset the phase timers
+        : param images: batch size, for images_per_sec
+        : param fields: anything else to record (loss, ...)
+        """
+        now = time.perf_counter()
+        seconds = now - self._stepStart
+        self._stepStart = now
+
+        record = {"run": self.run, "step": self.steps}
+        record.update(self.context)
+        record["batch_s"] = seconds
+        for phase, phaseSeconds in self._timer.seconds.items():
+            record[phase + "_s"] = phaseSeconds
+            self.totals[phase] = self.totals.get(phase, 0.0) + phaseSeconds
+        if images is not None:
+            record["images"] = images
+            record["images_per_sec"] = images / seconds if seconds else 0.0
+        record.update(fields)
+
+        self._timer = PhaseTimer()
+        self.steps += 1
+        if self.sink is not None:
+            self.sink.write(record)
+        if self._profiler is not None:
+            self._profiler.step()
+        return record
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+        if self.sink is not None:
+            self.sink.close()
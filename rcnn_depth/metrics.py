@@ -0,0 +1,152 @@
+# Loss history that doesn't grow
+# LossHistory keeps scalar losses (never tensors, so no autograd graphs) in a
+# preallocated float32 array of fixed capacity. Once it is full the history
+# is either decimated (every other entry dropped, then only every 2nd, 4th,
+# ... new one kept) or reservoir sampled, so memory and checkpoint size stay
+# the same however long the run. The full history can be streamed to a raw
+# float32 file on the side.
+#
+# loss_history = LossHistory(filename="loss_attempt2.f32")
+# loss_history.append(regrLoss)
+# steps, values = loss_history.steps, loss_history.values
+
+import os
+
+import numpy as np
+import torch
+
+
+class LossHistory(object):
+    def __init__(self, capacity=4096, mode="decimate", filename=None,
+                 seed=0, flush_every=1024):
+        """
+        : param capacity: losses kept in memory (decimate needs it even)
+        : param mode: "decimate" keeps evenly spaced losses over the whole
+            run, "reservoir" a uniform random sample of them
+        : param filename: append every loss to this raw float32 file
+            (read_history reads it back)
+        : param flush_every: losses buffered before a write to filename
+        """
+        if mode not in ("decimate", "reservoir"):
+            raise ValueError("unknown mode %s" % mode)
+        if mode == "decimate" and capacity % 2:
+            raise ValueError("decimate needs an even capacity")
+        self.capacity = capacity
+        self.mode = mode
+        self.filename = filename
+        self._rng = np.random.default_rng(seed)
+
+        self._values = np.zeros(capacity, dtype=np.float32)
+        self._steps = np.zeros(capacity, dtype=np.int64)
+        self._stored = 0
+        self.count = 0  # losses seen
+        self.stride = 1  # decimate: keep every stride-th loss
+
+        self._buffer = np.zeros(flush_every if filename else 0,
+                                dtype=np.float32)
+        self._buffered = 0
+
+    def __len__(self):
+        return self._stored
+
+    def append(self, loss):
+        """
+        : param loss: python float, or a scalar tensor (only its value is
+            kept)
+        """
+        if torch.is_tensor(loss):
+            loss = loss.item()
+        step = self.count
+        self.count += 1
+
+        if self.filename:
+            self._buffer[self._buffered] = loss
+            self._buffered += 1
+            if self._buffered == len(self._buffer):
+                self.flush()
+
+        if self.mode == "decimate":
+            if step % self.stride:
+                return
+            if self._stored == self.capacity:
+                half = self.capacity // 2
+                self._values[:half] = self._values[::2]
+                self._steps[:half] = self._steps[::2]
+                self._stored = half
+                self.stride *= 2
+                if step % self.stride:
+                    return
+            slot = self._stored
+            self._stored += 1
+        else:
+            if self._stored < self.capacity:
+                slot = self._stored
+                self._stored += 1
+            else:
+                slot = self._rng.integers(0, step + 1)
+                if slot >= self.capacity:
+                    return
+        self._values[slot] = loss
+        self._steps[slot] = step
+
+    def flush(self):
+        """
+        Write buffered losses to filename
+        """
+        if self._buffered:
+            with open(self.filename, "ab") as f:
+                self._buffer[:self._buffered].tofile(f)
+            self._buffered = 0
+
+    @property
+    def steps(self):
+        # in step order (reservoir slots are not)
+        return self._steps[self._order()]
+
+    @property
+    def values(self):
+        return self._values[self._order()]
+
+    def _order(self):
+        if self.mode == "decimate":
+            return slice(0, self._stored)
+        return np.argsort(self._steps[:self._stored], kind="stable")
+
+    def state_dict(self):
+        """
+        Tensors and ints only, so it can go into a checkpoint.py checkpoint.
+        Flushes filename first, so the file matches the checkpoint.
+        """
+        if self.filename:
+            self.flush()
+        return {"values": torch.from_numpy(self._values[:self._stored]),
+                "steps": torch.from_numpy(self._steps[:self._stored]),
+                "count": self.count, "stride": self.stride}
+
+    def load_state_dict(self, state):
+        """
+        Restore a state_dict; losses written to filename after it was taken
+        (by a run that died before its next checkpoint) are cut off
+        """
+        stored = len(state["values"])
+        if stored > self.capacity:
+            raise ValueError("history of %d losses doesn't fit capacity %d"
+                             % (stored, self.capacity))
+        self._values[:stored] = np.asarray(state["values"])
+        self._steps[:stored] = np.asarray(state["steps"])
+        self._stored = stored
+        self.count = int(state["count"])
+        self.stride = int(state["stride"])
+        self._buffered = 0
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename, "r+b") as f:
+                f.truncate(self.count * np.dtype(np.float32).itemsize)
+
+
+def read_history(filename):
+    """
+    Every loss streamed to a LossHistory's file, memory mapped
+    """
+    if not os.path.getsize(filename):
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(filename, dtype=np.float32, mode="r")
@@ -0,0 +1,450 @@
+# Depth image networks
+# Net from attempt2.py and classifNet / regrNet from v5_Sliding Window.py,
+# importable without running the training scripts, plus a fully
+# convolutional variant of the classifier and a regressor that works on
+# single crops, and multiTaskNet: both heads on one shared backbone.
+# Depth and width of every net are arguments (channels, hidden), the layer
+# sizes in between are found by a dry run (convLayers / fcLayers / dryRun).
+
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from rectgen import IMG_X, IMG_Y
+import windows
+
+
+# -- Layer builders -------------------------------------------------------
+# Layer sizes come from a dry run of the conv layers on a dummy input instead
+# of being worked out by hand for one kernel and pool size, so any image /
+# crop size and any depth and width of layers fit together, and a size that
+# is too small fails when the model is made rather than mid training.
+
+CHANNELS = (6, 16)  # conv output channels, one conv -> relu -> pool per entry
+HIDDEN = (120, 84)  # fc layer widths before the output layer
+KERNEL = 5
+POOL = 2
+
+
+def convLayers(inChannels, channels=CHANNELS, kernel=KERNEL, pool=POOL,
+               adaptive=None, flatten=True):
+    """
+    conv -> relu -> max pool blocks, the convs named conv1, conv2, ...
+    : param channels: output channels of every conv, its length is the depth
+    : param adaptive: (h, w) to average pool the last feature map to, so the
+        number of features no longer depends on the input size
+    """
+    layers = OrderedDict()
+    for i, outChannels in enumerate(channels, 1):
+        layers["conv%d" % i] = nn.Conv2d(inChannels, outChannels, kernel)
+        layers["relu%d" % i] = nn.ReLU()
+        layers["pool%d" % i] = nn.MaxPool2d(pool, pool)
+        inChannels = outChannels
+    if adaptive is not None:
+        layers["adaptive"] = nn.AdaptiveAvgPool2d(adaptive)
+    if flatten:
+        layers["flatten"] = nn.Flatten()
+    return nn.Sequential(layers)
+
+
+def fcLayers(inFeatures, hidden, outFeatures, name="fc", first=1):
+    """
+    Linear -> relu for every hidden width, then a plain linear output layer,
+    named fc1, fc2, ... (name, first)
+    """
+    layers = OrderedDict()
+    for i, width in enumerate(list(hidden) + [outFeatures], first):
+        layers["%s%d" % (name, i)] = nn.Linear(inFeatures, width)
+        if i < first + len(hidden):
+            layers["relu%d" % i] = nn.ReLU()
+        inFeatures = width
+    return nn.Sequential(layers)
+
+
+def dryRun(layers, inShape):
+    """
+    Output shape of layers for one (C, H, W) input
+    """
+    try:
+        with torch.no_grad():
+            out = layers(torch.zeros((1,) + tuple(inShape)))
+    except RuntimeError as e:
+        raise ValueError("input of shape %s is too small for these layers: %s"
+                         % (tuple(inShape), e))
+    if out.numel() == 0:
+        raise ValueError("input of shape %s is too small for these layers"
+                         % (tuple(inShape),))
+    return tuple(out.shape[1:])
+
+
+def _legacyKeys(module, state_dict, prefix, *args):
+    # state_dicts from before the layers were built by convLayers / fcLayers
+    # say conv1.weight where it is now features.conv1.weight
+    if not hasattr(module, "_legacyNames"):
+        module._legacyNames = {}
+        for name in module.state_dict():
+            short = ".".join(name.split(".")[-2:])
+            if short != name:
+                module._legacyNames[short] = name
+    for key in list(state_dict):
+        short = key[len(prefix):]
+        if key.startswith(prefix) and short in module._legacyNames:
+            state_dict[prefix + module._legacyNames[short]] = \
+                state_dict.pop(key)
+
+
+# -- Define NN -------------------------------------------------------
+
+
+class Net(nn.Module):  # CIFAR is 32x32x3, MNIST is 28x28pred_x)
+    def __init__(self, IMG_X, IMG_Y, channels=CHANNELS, hidden=HIDDEN,
+                 kernel=KERNEL, pool=POOL, adaptive=None):
+        """
+        : param channels, hidden, kernel, pool, adaptive: layer config, see
+            convLayers / fcLayers
+        """
+        super(Net, self).__init__()
+
+        self._imgx = IMG_X
+        self._imgy = IMG_Y
+
+        num_classes = 3
+
+        self.features = convLayers(3, channels, kernel, pool, adaptive)
+        self._const = dryRun(self.features, (3, IMG_Y, IMG_X))[0]
+        self.head = fcLayers(self._const, hidden, num_classes)
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+
+    def forward(self, x):
+        #print(x.size())
+        x = x.to(self.features.conv1.weight.device)
+        x = x.reshape(-1, 3, x.shape[-2], x.shape[-1])
+        x = self.features(x)
+        x = self.head(x)
+        return x
+
+
+class regrNet(nn.Module):
+    def __init__(self, cropSize, numOutputs, IMG_X=IMG_X, IMG_Y=IMG_Y,
+                 stepSize=windows.STEPSIZE, channels=CHANNELS, hidden=HIDDEN,
+                 kernel=KERNEL, pool=POOL, adaptive=None):
+        """
+        We need the image width and height to determine CNN layer sizes
+        : param channels, hidden, kernel, pool, adaptive: layer config, see
+            convLayers / fcLayers
+        """
+        super(regrNet, self).__init__()
+
+        self.step = stepSize
+        self.cropSize = cropSize
+        self.numOutputs = numOutputs
+
+        # calculate number of crops
+        self.numCrops = windows.numCrops((IMG_Y, IMG_X), cropSize, stepSize)
+
+        # --- LOCATION OF RECTANGLE
+        # NOTE: only one channel for now (black/white)
+        self.features = convLayers(self.numCrops, channels, kernel, pool,
+                                   adaptive)
+        self._const = dryRun(self.features,
+                             (self.numCrops, cropSize[0], cropSize[1]))[0]
+        self.head = fcLayers(self._const, hidden,
+                             self.numOutputs * self.numCrops)
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+
+    def forward(self, crops, labels):
+        """
+        Forward propogation
+        : param image: images, a tensor of dimensions(N, 3, IMG_X, IMG_Y)
+        : return: (x, y, theta) and T/F for each window
+        """
+        crops = crops.to(self.features.conv1.weight.device)
+
+        crops = self.zeroCrops(crops, labels)
+
+        # LOCALIZATION
+        regr_crops = self.features(crops)
+        regr_crops = self.head(regr_crops)
+
+        objCoords = regr_crops
+        # reshape to batchsize x number of crops x 3
+        objCoords = objCoords.reshape(-1, self.numCrops, self.numOutputs)
+        return objCoords
+
+    def zeroCrops(self, crops, labels):
+        # 15 x 9
+        # 15 x 9 x 100 x 100
+        labels = torch.as_tensor(labels, dtype=crops.dtype,
+                                 device=crops.device)
+        mask = labels.unsqueeze(2)
+        mask.unsqueeze_(3)
+        crops = crops * mask
+        return crops
+
+
+class cropRegrNet(nn.Module):
+    def __init__(self, cropSize=windows.WINDOWSIZE, numOutputs=3,
+                 channels=CHANNELS, hidden=HIDDEN, kernel=KERNEL, pool=POOL,
+                 adaptive=None):
+        """
+        regrNet for single crops: takes any number of (1, h, w) windows and
+        predicts (x, y, theta) relative to each window's top left corner,
+        so it can run on only the windows the classifier picked
+        """
+        super(cropRegrNet, self).__init__()
+
+        self.cropSize = cropSize
+        self.numOutputs = numOutputs
+
+        self.features = convLayers(1, channels, kernel, pool, adaptive)
+        self._const = dryRun(self.features, (1, cropSize[0], cropSize[1]))[0]
+        self.head = fcLayers(self._const, hidden, self.numOutputs)
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+
+    def forward(self, crops):
+        """
+        : param crops: (M, h, w) or (M, 1, h, w)
+        : return: (M, numOutputs)
+        """
+        crops = crops.to(self.features.conv1.weight.device).float()
+        if crops.dim() == 3:
+            crops = crops.unsqueeze(1)
+        x = self.features(crops)
+        x = self.head(x)
+        return x
+
+
+class classifNet(nn.Module):  # CIFAR is 32x32x3, MNIST is 28x28x1)
+    def __init__(self, IMG_X, IMG_Y, cropSize=windows.WINDOWSIZE,
+                 stepSize=windows.STEPSIZE, channels=CHANNELS, hidden=HIDDEN,
+                 kernel=KERNEL, pool=POOL, adaptive=None):
+        """
+        We need the image width and height to determine CNN layer sizes
+        : param channels, hidden, kernel, pool, adaptive: layer config, see
+            convLayers / fcLayers
+        """
+        super(classifNet, self).__init__()
+        self._imgx = IMG_X
+        self._imgy = IMG_Y
+
+        self.step = stepSize
+        self.cropSize = cropSize
+        # T/F for now
+
+        # calculate number of crops
+        self.numCrops = windows.numCrops((IMG_Y, IMG_X), cropSize, stepSize)
+
+        # --- CLASSIFICATION OF WINDOWS
+        # batch, 3 input image channels (RGB), 6 output channels, 5x5 square convolution
+        # NOTE: we switched to 1 input channel
+        self.features = convLayers(self.numCrops, channels, kernel, pool,
+                                   adaptive)
+        self._const = dryRun(self.features,
+                             (self.numCrops, cropSize[0], cropSize[1]))[0]
+        self.head = fcLayers(self._const, hidden, self.numCrops)
+        self.sigmoid = nn.Sigmoid()
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+        # TODO: batch normalization  self.bn = nn.BatchNorm2d()
+
+    def forward(self, x):
+        """
+        Forward propogation
+        : param image: images, a tensor of dimensions(N, 3, IMG_X, IMG_Y)
+        : return: (x, y, theta) and T/F for each window
+        """
+        x = x.to(self.features.conv1.weight.device).float()
+
+        # all windows of the whole batch at once, crops stacked as channels
+        all_crops = windows.makeCrops(x, self.cropSize, self.step)
+        feats = all_crops
+
+        # CLASSIFICATION of the windows
+        c_crops = self.features(feats)
+        c_crops = self.head(c_crops)
+        c_crops = self.sigmoid(c_crops)
+
+        containsObj = c_crops
+
+        return containsObj, all_crops
+
+    def makeCrops(self, image, stepSize, windowSize):
+        """
+        Returns a generator of cropped boxes(the top left x, y, the image data)
+        """
+        image = image.type(torch.FloatTensor).to(
+            self.features.conv1.weight.device)
+        # rows are y, columns are x: windows go along a row first
+        crops = windows.makeCrops(image, windowSize, stepSize)[0]
+        return crops
+
+
+class fcnClassifNet(nn.Module):
+    def __init__(self, cropSize=windows.WINDOWSIZE, stepSize=windows.STEPSIZE,
+                 channels=CHANNELS, hidden=HIDDEN, kernel=KERNEL, pool=POOL):
+        """
+        Fully convolutional window classifier. The conv stack runs once over
+        the whole (1 channel) depth image, and the fc layers are convolutions
+        over window sized patches of the feature map, so overlapping windows
+        share their conv features and any image size works.
+        Windows start on feature map cells, every pool ** len(channels)
+        pixels (4 with the defaults). With a stepSize that is a multiple of
+        that (e.g. 48) every score is exactly classifNet's window; otherwise,
+        like the default 50, each window is read from the nearest cell, up
+        to half a cell (2 pixels) away from the window classifNet scores.
+        """
+        super(fcnClassifNet, self).__init__()
+
+        self.step = stepSize
+        self.cropSize = cropSize
+        # image pixels per feature map cell
+        self._scale = pool ** len(channels)
+
+        self.features = convLayers(1, channels, kernel, pool, flatten=False)
+        featShape = dryRun(self.features, (1, cropSize[0], cropSize[1]))
+
+        # fc layers as convs: fc1 sees exactly one window of features
+        layers = OrderedDict()
+        inChannels, size = featShape[0], featShape[1:]
+        for i, width in enumerate(list(hidden) + [1], 1):
+            layers["fc%d" % i] = nn.Conv2d(inChannels, width, size)
+            if i <= len(hidden):
+                layers["relu%d" % i] = nn.ReLU()
+            inChannels, size = width, 1
+        layers["sigmoid"] = nn.Sigmoid()
+        self.head = nn.Sequential(layers)
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+
+    def scoreMap(self, x):
+        """
+        Dense window scores
+        : param x: images, (N, IMG_Y, IMG_X) or (N, 1, IMG_Y, IMG_X)
+        : return: (N, H', W'); cell (i, j) scores the window whose top left
+            corner is at pixel (i * 4, j * 4) (with the default two pools)
+        """
+        x = x.to(self.features.conv1.weight.device).float()
+        if x.dim() == 3:
+            x = x.unsqueeze(1)
+        x = self.features(x)
+        x = self.head(x)
+        return x[:, 0]
+
+    def cellIndex(self, imgSize, mapSize, cropSize):
+        # type: (int, int, int) -> torch.Tensor
+        """
+        Feature map cell of every window along one image axis (nearest when
+        the step is not a multiple of the cell size); torch ops only, so the
+        model scripts and traces
+        : param imgSize, mapSize, cropSize: lengths along that axis
+        : return: (windows along the axis,) int64
+        """
+        num = max((imgSize - cropSize) // self.step + 1, 0)
+        starts = torch.arange(num, device=self.features.conv1.weight.device)
+        cells = torch.round(starts.float() * self.step / self._scale)
+        return cells.clamp(0, mapSize - 1).long()
+
+    def forward(self, x):
+        """
+        : return: (N, numCrops) probability that each window contains a block,
+            in makeCrops order
+        """
+        scores = self.scoreMap(x)
+        iy = self.cellIndex(x.shape[-2], scores.shape[-2], self.cropSize[0])
+        ix = self.cellIndex(x.shape[-1], scores.shape[-1], self.cropSize[1])
+        containsObj = scores[:, iy][:, :, ix]
+        return containsObj.reshape(len(scores), -1)
+
+
+class multiTaskNet(nn.Module):
+    def __init__(self, IMG_X=IMG_X, IMG_Y=IMG_Y, cropSize=windows.WINDOWSIZE,
+                 stepSize=windows.STEPSIZE, numOutputs=3, channels=CHANNELS,
+                 hidden=HIDDEN, kernel=KERNEL, pool=POOL, adaptive=None):
+        """
+        classifNet and regrNet in one: the crops go through one shared conv
+        backbone (and fc1), like classifNet's, then a classification head
+        (window contains a block, t/f) and a regression head (x, y, theta
+        per window), so one forward pass gives both and training needs a
+        single pass over the data
+        : param channels, hidden, kernel, pool, adaptive: layer config, see
+            convLayers / fcLayers; hidden[0] is the shared fc1, the heads
+            get the rest
+        """
+        super(multiTaskNet, self).__init__()
+
+        self.step = stepSize
+        self.cropSize = cropSize
+        self.numOutputs = numOutputs
+        self.numCrops = windows.numCrops((IMG_Y, IMG_X), cropSize, stepSize)
+
+        # --- shared backbone, crops stacked as channels
+        self.features = convLayers(self.numCrops, channels, kernel, pool,
+                                   adaptive)
+        self._const = dryRun(self.features,
+                             (self.numCrops, cropSize[0], cropSize[1]))[0]
+        self.shared = nn.Sequential(OrderedDict([
+            ("fc1", nn.Linear(self._const, hidden[0])), ("relu1", nn.ReLU())]))
+        # --- CLASSIFICATION OF WINDOWS
+        self.classHead = fcLayers(hidden[0], hidden[1:], self.numCrops,
+                                  "classFc", first=2)
+        self.sigmoid = nn.Sigmoid()
+        # --- LOCATION OF RECTANGLE
+        self.regrHead = fcLayers(hidden[0], hidden[1:],
+                                 self.numOutputs * self.numCrops, "regrFc",
+                                 first=2)
+        self._register_load_state_dict_pre_hook(_legacyKeys, with_module=True)
+
+    def forward(self, x):
+        """
+        : param x: images, (N, IMG_Y, IMG_X)
+        : return: containsObj (N, numCrops), objCoords (N, numCrops, 3)
+        """
+        x = x.to(self.features.conv1.weight.device).float()
+
+        all_crops = windows.makeCrops(x, self.cropSize, self.step)
+        feats = self.shared(self.features(all_crops))
+
+        containsObj = self.sigmoid(self.classHead(feats))
+
+        objCoords = self.regrHead(feats)
+        # reshape to batchsize x number of crops x 3
+        objCoords = objCoords.reshape(-1, self.numCrops, self.numOutputs)
+        return containsObj, objCoords
+
+
+# -- Define Loss -------------------------------------------------------
+
+
+class MultiObjLoss(nn.Module):
+    def __init__(self, alpha=1.0, positiveOnly=True):
+        """
+        Weighted sum of window classification (BCE) and location (smooth L1)
+        losses, for multiTaskNet
+        : param alpha: some weighting between class vs regr loss
+        : param positiveOnly: location loss only over windows that contain a
+            block; the empty windows' (0, 0, 0) labels are not locations
+        """
+        super(MultiObjLoss, self).__init__()
+        self.smooth_l1 = nn.SmoothL1Loss()
+        self.cross_entropy = nn.BCELoss()
+        self.alpha = alpha
+        self.positiveOnly = positiveOnly
+
+    def forward(self, predicted_classes, predicted_locs, labels, coords):
+        """
+        : return: total loss, and its classification and location parts
+        """
+        predicted_classes = predicted_classes.float()
+        predicted_locs = predicted_locs.float()
+        conf_loss = self.cross_entropy(predicted_classes, labels)
+
+        if self.positiveOnly:
+            positive = labels > 0.5
+            if positive.any():
+                loc_loss = self.smooth_l1(predicted_locs[positive],
+                                          coords[positive])
+            else:
+                loc_loss = predicted_locs.sum() * 0
+        else:
+            loc_loss = self.smooth_l1(predicted_locs, coords)
+
+        return conf_loss + self.alpha * loc_loss, conf_loss, loc_loss
@@ -0,0 +1,431 @@
+# Packed depth image datasets
+# All images of a dataset live in one uint8 file that is memory mapped,
+# instead of one png per sample that has to be decoded every epoch.
+#
+# Layout of a packed file:
+#   [header, HEADER_SIZE bytes]  magic + json (IMG_X, IMG_Y, block size, ...)
+#   [images]                     num_images x IMG_Y x IMG_X uint8 (binary
+#                                images) or float32 (depth maps)
+#   [coords]                     num_images x num_rects x 3 float32,
+#                                (x, y, theta) of every block
+#
+# create_packed("data.rects", 500)
+# train_dataset = PackedDepthDataset("data.rects")
+# train_loader = make_loader(train_dataset, batch_size=15, workers=4)
+#
+# Or skip the disk entirely, images are made in the loader workers:
+# train_dataset = ProceduralDepthDataset(seed=0)
+
+import itertools
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import (Dataset, DataLoader, IterableDataset,
+                              get_worker_info)
+
+from rectgen import (IMG_X, IMG_Y, block_l, block_w, random_rects,
+                     render_rects, render_depth)
+import windows
+
+MAGIC = b"RECTPACK"
+HEADER_SIZE = 4096
+_ALIGN = 64
+
+
+def _layout(header):
+    """
+    Byte offsets of the image and coord blocks for a header
+    """
+    images_offset = HEADER_SIZE
+    images_size = header["num_images"] * header["IMG_Y"] * header["IMG_X"]
+    images_size *= np.dtype(header.get("dtype", "uint8")).itemsize
+    coords_offset = images_offset + images_size
+    coords_offset += -coords_offset % _ALIGN
+    coords_size = header["num_images"] * header.get("num_rects", 1)
+    coords_size *= header["coords_dim"] * 4
+    return images_offset, coords_offset, coords_offset + coords_size
+
+
+def _write_header(f, header):
+    blob = MAGIC + json.dumps(header).encode("utf-8")
+    if len(blob) > HEADER_SIZE:
+        raise ValueError("header does not fit in %d bytes" % HEADER_SIZE)
+    f.write(blob.ljust(HEADER_SIZE, b" "))
+
+
+def read_header(filename):
+    with open(filename, "rb") as f:
+        blob = f.read(HEADER_SIZE)
+    if not blob.startswith(MAGIC):
+        raise ValueError("%s is not a packed rectangle dataset" % filename)
+    return json.loads(blob[len(MAGIC):].decode("utf-8"))
+
+
+def open_packed(filename, mode="r"):
+    """
+    Memory map a packed file
+    : return: header, images (N, IMG_Y, IMG_X) uint8 or float32,
+        coords (N, 3) float32 ((N, num_rects, 3) for scenes with several
+        blocks)
+    """
+    header = read_header(filename)
+    images_offset, coords_offset, _ = _layout(header)
+    num_images = header["num_images"]
+    images = np.memmap(filename, dtype=header.get("dtype", "uint8"), mode=mode,
+                       offset=images_offset,
+                       shape=(num_images, header["IMG_Y"], header["IMG_X"]))
+    num_rects = header.get("num_rects", 1)
+    coords_shape = (num_images, header["coords_dim"])
+    if num_rects > 1:
+        coords_shape = (num_images, num_rects, header["coords_dim"])
+    coords = np.memmap(filename, dtype=np.float32, mode=mode,
+                       offset=coords_offset, shape=coords_shape)
+    return header, images, coords
+
+
+def _allocate(filename, num_images, img_x, img_y, l, w, num_rects=1,
+              dtype="uint8"):
+    header = {
+        "dtype": dtype,
+        "IMG_X": img_x,
+        "IMG_Y": img_y,
+        "block_l": l,
+        "block_w": w,
+        "num_images": num_images,
+        "num_rects": num_rects,
+        "coords_dim": 3,
+    }
+    with open(filename, "wb") as f:
+        _write_header(f, header)
+        f.truncate(_layout(header)[2])
+    return open_packed(filename, mode="r+")
+
+
+def write_packed(filename, images, coords, l=block_l, w=block_w):
+    """
+    Pack already generated images (N, IMG_Y, IMG_X), uint8 or float32 depth,
+    and coords (N, 3) or (N, num_rects, 3)
+    """
+    images = np.asarray(images)
+    coords = np.asarray(coords)
+    num_images, img_y, img_x = images.shape
+    num_rects = coords.shape[1] if coords.ndim == 3 else 1
+    dtype = "float32" if images.dtype.kind == "f" else "uint8"
+    _, out_images, out_coords = _allocate(filename, num_images, img_x, img_y,
+                                          l, w, num_rects, dtype)
+    out_images[:] = images
+    out_coords[:] = coords
+    out_images.flush()
+    out_coords.flush()
+
+
+def create_packed(filename, num_images, img_x=IMG_X, img_y=IMG_Y, l=block_l,
+                  w=block_w, rng=None, num_rects=1, depth=False, **depth_args):
+    """
+    Generate a dataset straight into a packed file, no pngs on the way
+    : param depth: store float32 depth maps (render_depth, which takes the
+        extra depth_args) instead of binary uint8 images
+    """
+    newpath = os.path.dirname(filename)
+    if newpath and not os.path.exists(newpath):
+        os.makedirs(newpath)
+    dtype = "float32" if depth else "uint8"
+    _, images, coords = _allocate(filename, num_images, img_x, img_y, l, w,
+                                  num_rects, dtype)
+    xs, ys, orients = random_rects(num_images, img_x, img_y, l, w, rng=rng,
+                                   num_rects=num_rects)
+    if depth:
+        render_depth(xs, ys, orients, l, w, img_x, img_y, out=images,
+                     rng=rng, **depth_args)
+    else:
+        render_rects(xs, ys, orients, l, w, img_x, img_y, out=images)
+    coords[:] = np.stack((xs, ys, orients), axis=-1)
+    images.flush()
+    coords.flush()
+    return np.array(coords)
+
+
+def pack_dataset(img_dir, coords, filename, l=block_l, w=block_w):
+    """
+    Convert an existing png dataset (rect<idx>.png + truth array) once
+    """
+    from skimage import io
+
+    coords = np.asarray(coords)
+    num_rects = coords.shape[1] if coords.ndim == 3 else 1
+    first = io.imread(img_dir + "/rect0.png", as_gray=True)
+    img_y, img_x = first.shape
+    _, images, out_coords = _allocate(filename, len(coords), img_x, img_y,
+                                      l, w, num_rects)
+    for idx in range(len(coords)):
+        image = io.imread(img_dir + "/rect" + str(idx) + ".png", as_gray=True)
+        if image.dtype != np.uint8:
+            image = np.round(image * 255)
+        images[idx] = image
+    out_coords[:] = coords
+    images.flush()
+    out_coords.flush()
+
+
+# Define Dataloader -------------------------------------------------------
+
+class RectDepthImgsDataset(Dataset):
+    """Artificially generated depth images dataset, one png per image"""
+
+    def __init__(self, img_dir, coords, transform=None,
+                 windowSize=windows.WINDOWSIZE, stepSize=windows.STEPSIZE,
+                 margin=windows.MARGIN_PX):
+        """
+        Samples are (image, labels, cropCoords), with the window labels of
+        the whole dataset cached in <img_dir>/window_labels.npz, or
+        (image, coords) with windowSize=None (e.g. to augment batches and
+        label their windows afterwards, augment.WindowBatches)
+        """
+        self.img_dir = img_dir
+        self.true_coords = coords
+        self.transform = transform
+
+        self.step = stepSize
+        self.cropSize = windowSize
+        self.detectMargin = margin
+
+        if windowSize is not None:
+            # window labels for the whole dataset, computed once and cached
+            self.hasRects, self.rectCoords = windows.cachedWindowLabels(
+                self.img_dir + "/window_labels.npz", coords, (IMG_Y, IMG_X),
+                self.cropSize, self.step, self.detectMargin)
+
+    def __len__(self):
+        return len(self.true_coords)
+
+    def __getitem__(self, idx):
+        from skimage import io
+
+        image = io.imread(self.img_dir + "/rect" +
+                          str(idx) + ".png", as_gray=True)
+
+        if self.transform:
+            image = self.transform(image)
+
+        if self.cropSize is None:
+            return image, torch.from_numpy(
+                np.asarray(self.true_coords[idx], dtype=np.float32))
+
+        labels = torch.from_numpy(self.hasRects[idx]).float()
+        cropCoords = torch.from_numpy(self.rectCoords[idx])
+
+        sample = image, labels, cropCoords
+        return sample
+
+
+def windowLabelsFile(filename, windowSize, stepSize, margin):
+    """
+    Window label cache of a packed file, separate per window setting so
+    datasets with different windows can share one packed file
+    """
+    return "%s.windows_%dx%d_s%d_m%d.npz" % (filename, windowSize[0],
+                                             windowSize[1], stepSize, margin)
+
+
+class PackedDepthDataset(Dataset):
+    """Artificially generated depth images dataset, from one packed file"""
+
+    def __init__(self, filename, transform=None, windowSize=None,
+                 stepSize=windows.STEPSIZE, margin=windows.MARGIN_PX):
+        """
+        Images come back as (IMG_Y, IMG_X) views into the file: uint8 binary
+        images (scale a whole batch at once, images.float() / 255, to match
+        as_gray pngs) or float32 depth maps that need no conversion.
+        Without a windowSize samples are (image, coords); with one they are
+        (image, labels, cropCoords) per window, like the sliding window
+        dataset, with the labels cached next to the file, one cache per
+        window setting (windowLabelsFile).
+        """
+        self.filename = filename
+        self.transform = transform
+        self.header = read_header(filename)
+        self.windowSize = windowSize
+        if windowSize is not None:
+            _, _, coords = open_packed(filename)
+            imgShape = (self.header["IMG_Y"], self.header["IMG_X"])
+            self.hasRects, self.rectCoords = windows.cachedWindowLabels(
+                windowLabelsFile(filename, windowSize, stepSize, margin),
+                coords, imgShape, windowSize, stepSize, margin)
+        # opened lazily, so every DataLoader worker maps the file itself
+        self._images = None
+        self._coords = None
+
+    def _open(self):
+        # copy-on-write: pages stay shared in the page cache, and torch gets
+        # a writable array so from_numpy does not have to copy
+        _, self._images, self._coords = open_packed(self.filename, mode="c")
+
+    def __len__(self):
+        return self.header["num_images"]
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._open()
+        image = torch.from_numpy(self._images[idx])
+        coords = torch.from_numpy(self._coords[idx])
+
+        if self.transform:
+            image = self.transform(image)
+
+        if self.windowSize is not None:
+            labels = torch.from_numpy(self.hasRects[idx]).float()
+            cropCoords = torch.from_numpy(self.rectCoords[idx])
+            return image, labels, cropCoords
+        return image, coords
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_coords"] = None
+        return state
+
+
+class ProceduralDepthDataset(IterableDataset):
+    """Artificially generated depth images dataset, made on the fly"""
+
+    def __init__(self, num_images=None, seed=0, img_x=IMG_X, img_y=IMG_Y,
+                 l=block_l, w=block_w, num_rects=1, transform=None,
+                 windowSize=None, stepSize=windows.STEPSIZE,
+                 margin=windows.MARGIN_PX, chunk=64, depth=False,
+                 depth_args=None):
+        """
+        Samples are rendered in chunks of `chunk` images inside the loader
+        workers. Chunk i always comes from the seed (seed, i), so every run
+        gives the same multiset of samples for any number of workers,
+        without storing anything; their order depends on how the loader
+        interleaves the workers' chunks, so it only repeats with the same
+        number of workers. num_images=None streams forever.
+        Samples look like PackedDepthDataset's: (image, coords), or
+        (image, labels, cropCoords) when a windowSize is given. With depth,
+        images are float32 depth maps from render_depth(**depth_args).
+        """
+        self.num_images = num_images
+        self.seed = seed
+        self.img_x, self.img_y = img_x, img_y
+        self.l, self.w = l, w
+        self.num_rects = num_rects
+        self.transform = transform
+        self.windowSize = windowSize
+        self.stepSize = stepSize
+        self.margin = margin
+        self.chunk = chunk
+        self.depth = depth
+        self.depth_args = depth_args or {}
+        if windowSize is not None:
+            self.grid = windows.windowGrid((img_y, img_x), windowSize,
+                                           stepSize)
+
+    def __len__(self):
+        if self.num_images is None:
+            raise TypeError("an endless ProceduralDepthDataset has no len()")
+        return self.num_images
+
+    def render_chunk(self, chunk_idx):
+        """
+        Images, coords (and window labels) of samples
+        chunk_idx * chunk .. (chunk_idx + 1) * chunk
+        """
+        rng = np.random.default_rng((self.seed, chunk_idx))
+        count = self.chunk
+        if self.num_images is not None:
+            count = min(count, self.num_images - chunk_idx * self.chunk)
+        xs, ys, orients = random_rects(count, self.img_x, self.img_y, self.l,
+                                       self.w, rng=rng,
+                                       num_rects=self.num_rects)
+        if self.depth:
+            images = render_depth(xs, ys, orients, self.l, self.w,
+                                  self.img_x, self.img_y, rng=rng,
+                                  **self.depth_args)
+        else:
+            images = render_rects(xs, ys, orients, self.l, self.w,
+                                  self.img_x, self.img_y)
+        coords = np.stack((xs, ys, orients), axis=-1).astype(np.float32)
+        if self.windowSize is None:
+            return images, coords, None
+        labels = windows.labelWindows(coords, self.grid, self.windowSize,
+                                      self.margin)
+        return images, coords, labels
+
+    def sample(self, idx):
+        """
+        Sample idx on its own, e.g. to look at one again
+        """
+        images, coords, labels = self.render_chunk(idx // self.chunk)
+        return self._make_sample(images, coords, labels, idx % self.chunk)
+
+    def _make_sample(self, images, coords, labels, j):
+        image = torch.from_numpy(images[j])
+        if self.transform:
+            image = self.transform(image)
+        if labels is not None:
+            hasRects, rectCoords = labels
+            return (image, torch.from_numpy(hasRects[j]).float(),
+                    torch.from_numpy(rectCoords[j]))
+        return image, torch.from_numpy(coords[j])
+
+    def __iter__(self):
+        # every worker takes every num_workers-th chunk
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        num_workers = worker.num_workers if worker is not None else 1
+        if self.num_images is None:
+            chunk_ids = itertools.count(worker_id, num_workers)
+        else:
+            num_chunks = -(-self.num_images // self.chunk)
+            chunk_ids = range(worker_id, num_chunks, num_workers)
+        for chunk_idx in chunk_ids:
+            images, coords, labels = self.render_chunk(chunk_idx)
+            for j in range(len(images)):
+                yield self._make_sample(images, coords, labels, j)
+
+
+# -- Data loader -------------------------------------------------------
+
+def seed_worker(worker_id):
+    """
+    Seed numpy / random in each DataLoader worker from torch's per worker
+    seed, so random transforms differ between workers but repeat across runs
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def make_loader(dataset, batch_size=15, workers=4, shuffle=True,
+                pin_memory=None, prefetch_factor=2, persistent_workers=True,
+                seed=None, drop_last=False):
+    """
+    DataLoader for the depth image datasets, all loading settings in one place
+    : param workers: loader processes, 0 loads in the training process
+    : param pin_memory: page locked batches for faster copies to the gpu,
+        defaults to whether cuda is available
+    : param prefetch_factor: batches each worker loads ahead
+    : param persistent_workers: keep workers (and their open files) alive
+        between epochs instead of forking new ones every epoch
+    : param seed: fixes shuffling order and worker seeds
+    """
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    if isinstance(dataset, IterableDataset):
+        # streamed datasets come in their own (seeded) order
+        shuffle = False
+    kwargs = {}
+    if workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor
+        kwargs["persistent_workers"] = persistent_workers
+        kwargs["worker_init_fn"] = seed_worker
+    if seed is not None:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        kwargs["generator"] = generator
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                      num_workers=workers, pin_memory=pin_memory,
+                      drop_last=drop_last, **kwargs)
@@ -0,0 +1,167 @@
+# Batched synthetic depth images
+# Rasterizes many rotated rectangles at once with numpy, instead of drawing
+# each one with ImageDraw.polygon and saving it to its own png. render_rects
+# gives the old binary images, render_depth single channel float depth.
+
+import math
+
+import numpy as np
+
+IMG_X, IMG_Y = 200, 200
+# length and width of blocks (fixed for now)
+block_l, block_w = 20, 30
+
+
+# -- Calc rectangle vertices. credit Sparkler, stackoverflow, feb 17
+def makeRectangle(l, w, theta, offset=(0, 0)):
+    c, s = math.cos(theta), math.sin(theta)
+    rectCoords = [(l / 2.0, w / 2.0), (l / 2.0, -w / 2.0),
+                  (-l / 2.0, -w / 2.0), (-l / 2.0, w / 2.0)]
+    return [(c * x - s * y + offset[0],
+             s * x + c * y + offset[1]) for (x, y) in rectCoords]
+
+
+def makeRectangles(l, w, thetas, offsets):
+    """
+    Same as makeRectangle, for N rectangles at once
+    : param thetas: (N,) orientations in radians
+    : param offsets: (N, 2) rectangle centers, as (x, y)
+    : return: (N, 4, 2) array of vertices
+    """
+    thetas = np.asarray(thetas, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.float64)
+    c, s = np.cos(thetas)[:, None], np.sin(thetas)[:, None]
+    rectCoords = np.array([(l / 2.0, w / 2.0), (l / 2.0, -w / 2.0),
+                           (-l / 2.0, -w / 2.0), (-l / 2.0, w / 2.0)])
+    x, y = rectCoords[:, 0], rectCoords[:, 1]
+    vx = c * x - s * y + offsets[:, 0:1]
+    vy = s * x + c * y + offsets[:, 1:2]
+    return np.stack((vx, vy), axis=-1)
+
+
+def random_rects(num_images, img_x=IMG_X, img_y=IMG_Y, l=block_l, w=block_w,
+                 rng=None, num_rects=1):
+    """
+    Random block centers and orientations, drawn the same way make_dataset does
+    : return: xs, ys (int pixels) and orients (radians), each of shape (N,),
+        or (N, num_rects) for scenes with several blocks
+    """
+    rng = np.random if rng is None else rng
+    size = num_images if num_rects == 1 else (num_images, num_rects)
+    # block_l and _w offset so blocks don't run off edge of image
+    xs = (rng.random(size) * (img_x - 2 * l)).astype(np.int64) + l
+    ys = (rng.random(size) * (img_y - 2 * w)).astype(np.int64) + w
+    orients = (rng.random(size) * 180).astype(np.int64)  # degrees
+    return xs, ys, np.radians(orients)
+
+
+def render_rects(xs, ys, thetas, l=block_l, w=block_w, img_x=IMG_X,
+                 img_y=IMG_Y, out=None, fill=255, chunk=256):
+    """
+    Rasterize N rotated rectangles into an (N, img_y, img_x) uint8 array.
+    A pixel is filled when it lies inside the rectangle makeRectangle would
+    give for the same (l, w, theta, offset), tested for all pixels of a
+    chunk of images at once against one shared pixel grid.
+    : param xs, ys, thetas: (N,) for one block per image, or (N, R)
+    : param out: optional preallocated (N, img_y, img_x) array (or memmap)
+    : param chunk: images rasterized per step, bounds temporary memory
+    """
+    xs = np.asarray(xs, dtype=np.float64).reshape(len(xs), -1)
+    ys = np.asarray(ys, dtype=np.float64).reshape(xs.shape)
+    thetas = np.asarray(thetas, dtype=np.float64).reshape(xs.shape)
+    num_images = len(xs)
+    if out is None:
+        out = np.zeros((num_images, img_y, img_x), dtype=np.uint8)
+
+    grid_x = np.arange(img_x, dtype=np.float64)[None, None, :]
+    grid_y = np.arange(img_y, dtype=np.float64)[None, :, None]
+
+    for start in range(0, num_images, chunk):
+        end = min(start + chunk, num_images)
+        filled = np.zeros((end - start, img_y, img_x), dtype=bool)
+        for r in range(xs.shape[1]):
+            c = np.cos(thetas[start:end, r])[:, None, None]
+            s = np.sin(thetas[start:end, r])[:, None, None]
+            dx = grid_x - xs[start:end, r, None, None]
+            dy = grid_y - ys[start:end, r, None, None]
+            # rotate pixel offsets back into the rectangle's own frame
+            inside = np.abs(c * dx + s * dy) <= l / 2.0
+            inside &= np.abs(c * dy - s * dx) <= w / 2.0
+            filled |= inside
+        np.multiply(filled, fill, out=out[start:end], casting="unsafe")
+    return out
+
+
+def render_depth(xs, ys, thetas, l=block_l, w=block_w, img_x=IMG_X,
+                 img_y=IMG_Y, out=None, table_depth=1.0, block_height=0.05,
+                 table_slope=(0.0, 0.0), noise=0.0, supersample=4, rng=None,
+                 chunk=64):
+    """
+    Rasterize N rotated blocks into an (N, img_y, img_x) float32 depth map,
+    as seen by a camera looking straight down at a table.
+    Edges are anti-aliased: every pixel is sampled supersample x supersample
+    times and its depth mixes table and block top by the covered fraction.
+    : param xs, ys, thetas: (N,) for one block per image, or (N, R)
+    : param out: optional preallocated (N, img_y, img_x) float32 array, or a
+        (N, img_y, img_x) / (N, 1, img_y, img_x) cpu torch tensor that is
+        written in place
+    : param table_depth: camera to table distance at the image center
+    : param block_height: block top is this much closer to the camera
+    : param table_slope: (d/dx, d/dy) depth change per pixel of a tilted table
+    : param noise: std of gaussian sensor noise added to every pixel
+    """
+    xs = np.asarray(xs, dtype=np.float32).reshape(len(xs), -1)
+    ys = np.asarray(ys, dtype=np.float32).reshape(xs.shape)
+    thetas = np.asarray(thetas, dtype=np.float32).reshape(xs.shape)
+    num_images = len(xs)
+    if out is None:
+        out = np.empty((num_images, img_y, img_x), dtype=np.float32)
+    # torch tensors are written through a numpy view of the same memory
+    target = out.numpy() if hasattr(out, "numpy") else out
+    target = target.reshape(num_images, img_y, img_x)
+    rng = np.random if rng is None else rng
+
+    grid_x = np.arange(img_x, dtype=np.float32)[None, None, :]
+    grid_y = np.arange(img_y, dtype=np.float32)[None, :, None]
+    offsets = (np.arange(supersample, dtype=np.float32) + 0.5) / supersample
+    offsets -= 0.5
+    table = (table_depth +
+             table_slope[0] * (grid_x[0] - (img_x - 1) / 2.0) +
+             table_slope[1] * (grid_y[0] - (img_y - 1) / 2.0))
+
+    for start in range(0, num_images, chunk):
+        end = min(start + chunk, num_images)
+        c = np.cos(thetas[start:end])[:, :, None, None]
+        s = np.sin(thetas[start:end])[:, :, None, None]
+        coverage = np.zeros((end - start, img_y, img_x), dtype=np.float32)
+        for oy in offsets:
+            for ox in offsets:
+                dx = (grid_x + ox)[:, None] - xs[start:end, :, None, None]
+                dy = (grid_y + oy)[:, None] - ys[start:end, :, None, None]
+                # rotate sample offsets back into each block's own frame
+                inside = np.abs(c * dx + s * dy) <= l / 2.0
+                inside &= np.abs(c * dy - s * dx) <= w / 2.0
+                coverage += inside.any(axis=1)
+        coverage /= supersample * supersample
+
+        depth = target[start:end]
+        np.multiply(coverage, -block_height, out=depth)
+        depth += table
+        if noise:
+            depth += rng.normal(0.0, noise, depth.shape).astype(np.float32)
+    return out
+
+
+def make_batch(num_images, img_x=IMG_X, img_y=IMG_Y, l=block_l, w=block_w,
+               out=None, rng=None, num_rects=1):
+    """
+    Generate num_images depth images of num_rects randomly placed blocks each
+    (blocks may overlap)
+    : return: images (N, img_y, img_x) uint8, coords (N, 3) as (x, y, theta),
+        or (N, num_rects, 3) when num_rects > 1
+    """
+    xs, ys, orients = random_rects(num_images, img_x, img_y, l, w, rng=rng,
+                                   num_rects=num_rects)
+    images = render_rects(xs, ys, orients, l, w, img_x, img_y, out=out)
+    coords = np.stack((xs, ys, orients), axis=-1).astype(np.float64)
+    return images, coords
@@ -0,0 +1,211 @@
+# Headless result rendering
+# Truth and predicted blocks are drawn straight into numpy RGB tiles, a page
+# of samples at a time, with the same vectorized rasterizer that makes the
+# dataset (rectgen.render_rects), then tiled into contact sheet pngs or an
+# animated gif. No display, no matplotlib, no per patch python objects, so
+# thousands of predictions render in seconds on a server.
+#
+# python render.py regrNet_attempt2.pt --data test.rects --out sheets/attempt2
+#
+# Coords everywhere here are (x, y, theta in radians), like the packed
+# datasets.
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from rectgen import block_l, block_w, render_rects
+
+TRUTH_COLOR = (0, 200, 0)  # filled, see through
+PRED_COLOR = (255, 140, 0)  # outline and center cross
+OK_COLOR = (0, 160, 255)  # tile border when the prediction is within tolerance
+BAD_COLOR = (220, 0, 0)
+BACKGROUND = 32
+
+
+def xy_radians(coords, yx=False, degrees=False):
+    """
+    (N, 3) coords in some model's label convention as (x, y, radians)
+    """
+    coords = np.array(coords, dtype=np.float64)
+    if yx:
+        coords = coords[:, [1, 0, 2]]
+    if degrees:
+        coords[:, 2] = np.radians(coords[:, 2])
+    return coords
+
+
+def to_rgb(images):
+    """
+    (N, H, W) uint8 images, or float depth maps (scaled per image to
+    0..255, near = bright), as (N, H, W, 3) uint8
+    """
+    images = np.asarray(images)
+    if images.dtype != np.uint8:
+        images = images.astype(np.float32)
+        lo = images.min(axis=(1, 2), keepdims=True)
+        hi = images.max(axis=(1, 2), keepdims=True)
+        # depth: the block top is closer to the camera than the table
+        images = (hi - images) / np.maximum(hi - lo, 1e-6) * 255
+        images = images.astype(np.uint8)
+    return np.repeat(images[..., None], 3, axis=-1)
+
+
+def box_masks(coords, l=block_l, w=block_w, img_x=200, img_y=200,
+              thickness=0):
+    """
+    : param thickness: 0 for filled boxes, else outlines this many pixels
+        wide
+    : return: (N, img_y, img_x) bool
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    xs, ys, thetas = coords[:, 0], coords[:, 1], coords[:, 2]
+    masks = render_rects(xs, ys, thetas, l, w, img_x, img_y, fill=1)
+    masks = masks.astype(bool)
+    if thickness:
+        inner = render_rects(xs, ys, thetas, l - 2 * thickness,
+                             w - 2 * thickness, img_x, img_y, fill=1)
+        masks &= ~inner.astype(bool)
+    return masks
+
+
+def cross_masks(coords, img_x=200, img_y=200, size=3):
+    """
+    (N, img_y, img_x) bool masks of a + at every (x, y)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    cx = np.round(coords[:, 0])[:, None, None]
+    cy = np.round(coords[:, 1])[:, None, None]
+    dx = np.arange(img_x)[None, None, :] - cx
+    dy = np.arange(img_y)[None, :, None] - cy
+    return (((dy == 0) & (np.abs(dx) <= size)) |
+            ((dx == 0) & (np.abs(dy) <= size)))
+
+
+def _paint(tiles, mask, color, alpha=1.0):
+    # tiles (N, H, W, 3) uint8, mask (N, H, W) bool, in place
+    if alpha >= 1.0:
+        tiles[mask] = color
+    else:
+        pixels = tiles[mask].astype(np.float32)
+        pixels += alpha * (np.asarray(color, dtype=np.float32) - pixels)
+        tiles[mask] = pixels.astype(np.uint8)
+
+
+def overlay(images, truth, predicted=None, ok=None, l=block_l, w=block_w,
+            alpha=0.5, border=2):
+    """
+    Draw one batch of results
+    : param images: (N, H, W) uint8 or float depth
+    : param truth, predicted: (N, 3) as (x, y, theta)
+    : param ok: optional (N,) bool, colors a border around every tile
+    : return: (N, H, W, 3) uint8 tiles
+    """
+    tiles = to_rgb(images)
+    _, img_y, img_x, _ = tiles.shape
+    _paint(tiles, box_masks(truth, l, w, img_x, img_y), TRUTH_COLOR, alpha)
+    if predicted is not None:
+        _paint(tiles, box_masks(predicted, l, w, img_x, img_y, thickness=1),
+               PRED_COLOR)
+        _paint(tiles, cross_masks(predicted, img_x, img_y), PRED_COLOR)
+    if ok is not None:
+        edge = np.zeros((img_y, img_x), dtype=bool)
+        edge[:border] = edge[-border:] = True
+        edge[:, :border] = edge[:, -border:] = True
+        ok = np.asarray(ok, dtype=bool)
+        tiles[ok[:, None, None] & edge] = OK_COLOR
+        tiles[~ok[:, None, None] & edge] = BAD_COLOR
+    return tiles
+
+
+def contact_sheet(tiles, cols=16, pad=2):
+    """
+    Tile (N, H, W, 3) images into one (rows * (H + pad), cols * (W + pad), 3)
+    sheet, row by row
+    """
+    num, h, w, _ = tiles.shape
+    cols = min(cols, num)
+    rows = -(-num // cols)
+    sheet = np.full((rows * cols, h + pad, w + pad, 3), BACKGROUND,
+                    dtype=np.uint8)
+    sheet[:num, :h, :w] = tiles
+    sheet = sheet.reshape(rows, cols, h + pad, w + pad, 3)
+    sheet = sheet.transpose(0, 2, 1, 3, 4)
+    return sheet.reshape(rows * (h + pad), cols * (w + pad), 3)
+
+
+def render_sheets(prefix, images, truth, predicted=None, ok=None, cols=16,
+                  rows=16, gif=False, fps=2, **overlay_args):
+    """
+    Contact sheets of rows x cols samples, rendered and written one page at
+    a time, as <prefix>_000.png, ... (or frames of <prefix>.gif)
+    : return: filenames written
+    """
+    dirname = os.path.dirname(prefix)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    perPage = rows * cols
+    pages, filenames = [], []
+    for page, start in enumerate(range(0, len(truth), perPage)):
+        end = start + perPage
+        tiles = overlay(images[start:end], truth[start:end],
+                        None if predicted is None else predicted[start:end],
+                        None if ok is None else ok[start:end],
+                        **overlay_args)
+        sheet = Image.fromarray(contact_sheet(tiles, cols))
+        if gif:
+            pages.append(sheet)
+        else:
+            filenames.append("%s_%03d.png" % (prefix, page))
+            sheet.save(filenames[-1])
+    if gif and pages:
+        filenames.append(prefix + ".gif")
+        pages[0].save(filenames[-1], save_all=True, append_images=pages[1:],
+                      duration=int(1000 / fps), loop=0)
+    return filenames
+
+
+def main():
+    import argparse
+    import export
+    import evaluate
+    from rectdata import PackedDepthDataset, make_loader, open_packed
+
+    parser = argparse.ArgumentParser(
+        description="contact sheets of an exported regressor's predictions")
+    parser.add_argument("model", help="export.py TorchScript file")
+    parser.add_argument("--data", required=True, help="packed test set")
+    parser.add_argument("--out", default="sheets/results",
+                        help="output prefix")
+    parser.add_argument("--cols", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=16)
+    parser.add_argument("--limit", type=int, help="only the first N samples")
+    parser.add_argument("--center-tol", type=float, default=5.0)
+    parser.add_argument("--angle-tol", type=float, default=10.0)
+    parser.add_argument("--gif", action="store_true",
+                        help="one animated gif, a page per frame")
+    args = parser.parse_args()
+
+    model, metadata = export.load_model(args.model)
+    dataset = PackedDepthDataset(args.data)
+    loader = make_loader(dataset, batch_size=256, workers=0, shuffle=False)
+    predicted, truth = evaluate.evaluate_model(
+        model, loader, rgb=metadata.get("rgb", False),
+        scale=metadata.get("scale", False))
+    predicted = xy_radians(predicted, metadata.get("yx", False),
+                           metadata.get("degrees", False))
+    centerErr, angleErr = evaluate.grasp_errors(predicted, truth)
+    ok = (centerErr <= args.center_tol) & (angleErr <= args.angle_tol)
+
+    limit = args.limit or len(truth)
+    header, images, _ = open_packed(args.data)
+    filenames = render_sheets(args.out, images[:limit],
+                              truth[:limit], predicted[:limit], ok[:limit],
+                              args.cols, args.rows, args.gif,
+                              l=header["block_l"], w=header["block_w"])
+    print("\n".join(filenames))
+
+
+if __name__ == '__main__':
+    main()
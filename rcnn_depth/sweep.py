@@ -0,0 +1,325 @@
+# Hyperparameter sweeps
+# Every combination of window size, step, margin, learning rate, batch size
+# and block size is trained in its own process, a few at a time, each with a
+# fixed number of torch threads so the processes don't fight over cores. The
+# datasets (one packed file per block size) and their window labels are made
+# once up front; the runs memory map them read only and share the page cache.
+# Results end up in one table, ranked by the same grasp success metric for
+# every model type.
+#
+# python sweep.py --windows 100 80 --steps 50 40 --lrs 0.001 0.0003 \
+#     --procs 4 --threads 2 --out sweep.csv
+
+import argparse
+import concurrent.futures
+import contextlib
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from rectgen import IMG_X, IMG_Y, block_l, block_w
+from rectdata import create_packed, make_loader, PackedDepthDataset
+from models import classifNet, regrNet, multiTaskNet, MultiObjLoss
+from instrument import make_sink
+import evaluate
+import train
+import windows
+
+COLUMNS = ("model", "window", "step", "margin", "lr", "batch_size", "block",
+           "success", "window_acc", "center_px", "angle_deg", "val_loss",
+           "conf_loss", "loc_loss", "train_s", "images_per_sec")
+
+
+def _toFloat(image):
+    # packed images are uint8, like as_gray pngs * 255
+    return image.float() / 255
+
+
+def make_datasets(directory, blocks, num_train, num_val, seed=0):
+    """
+    One packed train and val file per block size, made once for the sweep
+    : return: {(l, w): (train file, val file)}
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = {}
+    for l, w in blocks:
+        names = []
+        for split, num in (("train", num_train), ("val", num_val)):
+            filename = os.path.join(directory,
+                                    "%s_%dx%d.rects" % (split, l, w))
+            if not os.path.exists(filename):
+                rng = np.random.default_rng((seed, l, w, len(names)))
+                create_packed(filename, num, l=l, w=w, rng=rng)
+            names.append(filename)
+        files[(l, w)] = tuple(names)
+    return files
+
+
+def make_configs(args):
+    configs = []
+    for (model, window, step, margin, lr, batch_size, block) in \
+            itertools.product(args.models, args.windows, args.steps,
+                              args.margins, args.lrs, args.batch_sizes,
+                              args.blocks):
+        configs.append({"model": model, "window": window, "step": step,
+                        "margin": margin, "lr": lr, "batch_size": batch_size,
+                        "block": block, "epochs": args.epochs,
+                        "seed": args.seed})
+    return configs
+
+
+def _parseBlock(text):
+    l, w = text.split("x")
+    return int(l), int(w)
+
+
+def _datasets(config, files):
+    windowSize = (config["window"], config["window"])
+    trainFile, valFile = files[_parseBlock(config["block"])]
+    return [PackedDepthDataset(filename, transform=_toFloat,
+                               windowSize=windowSize, stepSize=config["step"],
+                               margin=config["margin"])
+            for filename in (trainFile, valFile)]
+
+
+def _makeModels(config, windowSize):
+    """
+    : return: predict(images, labels) -> (containsObj, objCoords),
+        trainEpoch(loader, epoch), validate(loader) -> (val_loss, conf_loss,
+        loc_loss)
+    """
+    device = torch.device("cpu")
+    quiet = 10 ** 9  # print_freq
+    if config["model"] == "joint":
+        model = multiTaskNet(IMG_X, IMG_Y, windowSize, config["step"])
+        criterion = MultiObjLoss()
+        optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+        def predict(images, labels):
+            return model(images)
+
+        def trainEpoch(loader, epoch):
+            train.train_joint(loader, model, criterion, optimizer, epoch,
+                              device, quiet)
+
+        def validate(loader):
+            return train.validate_joint(loader, model, criterion, device,
+                                        quiet)
+        return predict, trainEpoch, validate
+
+    classifModel = classifNet(IMG_X, IMG_Y, windowSize, config["step"])
+    regrModel = regrNet(windowSize, 3, IMG_X, IMG_Y, config["step"])
+    optimizer1 = torch.optim.Adam(classifModel.parameters(), lr=config["lr"])
+    optimizer2 = torch.optim.Adam(regrModel.parameters(), lr=config["lr"])
+
+    def predict(images, labels):
+        containsObj, crops = classifModel(images)
+        return containsObj, regrModel(crops, containsObj)
+
+    def trainEpoch(loader, epoch):
+        train.train(loader, classifModel, regrModel, nn.BCELoss(),
+                    nn.MSELoss(), optimizer1, optimizer2, epoch, device,
+                    quiet)
+
+    def validate(loader):
+        conf_loss, loc_loss = train.validate(
+            loader, classifModel, regrModel, nn.BCELoss(), nn.MSELoss(),
+            device, quiet)
+        return conf_loss + loc_loss, conf_loss, loc_loss
+    return predict, trainEpoch, validate
+
+
+def _warmUp(config, windowSize, loader):
+    # one untimed training step of throwaway models of the same config, so
+    # the first config a worker runs doesn't pay torch's first call costs
+    # (thread pools, kernel selection for these shapes) in its train_s
+    warmLoader = [next(iter(loader))]
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        _, trainEpoch, _ = _makeModels(config, windowSize)
+        trainEpoch(warmLoader, 0)
+
+
+def score_windows(loader, predict, threshold=0.5, centerTol=5.0,
+                  angleTol=10.0):
+    """
+    The same grasp metric for every model: over windows that contain a
+    block, the fraction classified as such with coords within centerTol
+    pixels and angleTol degrees (evaluate.grasp_errors)
+    : return: dict of success, window_acc, center_px, angle_deg
+    """
+    detected, correct, total = [], 0, 0
+    centerErrs, angleErrs = [], []
+    with torch.no_grad():
+        for images, labels, coords in loader:
+            containsObj, objCoords = predict(images, labels)
+            positive = labels > 0.5
+            found = containsObj > threshold
+            correct += (found == positive).sum().item()
+            total += labels.numel()
+            centerErr, angleErr = evaluate.grasp_errors(
+                objCoords[positive].float().numpy(),
+                coords[positive].float().numpy())
+            centerErrs.append(centerErr)
+            angleErrs.append(angleErr)
+            detected.append(found[positive].numpy())
+    centerErr = np.concatenate(centerErrs)
+    angleErr = np.concatenate(angleErrs)
+    hits = (np.concatenate(detected) & (centerErr <= centerTol) &
+            (angleErr <= angleTol))
+    return {"success": float(hits.mean()) if len(hits) else 0.0,
+            "window_acc": correct / max(total, 1),
+            "center_px": float(np.median(centerErr)) if len(hits) else None,
+            "angle_deg": float(np.median(angleErr)) if len(hits) else None}
+
+
+def run_config(config, files):
+    """
+    Train one config for its epochs and validate it
+    : return: the config with its results (or the error) added
+    """
+    result = dict(config)
+    try:
+        windowSize = (config["window"], config["window"])
+        if windows.numCrops((IMG_Y, IMG_X), windowSize, config["step"]) < 1:
+            raise ValueError("window doesn't fit the image")
+        trainSet, valSet = _datasets(config, files)
+        trainLoader = make_loader(trainSet, batch_size=config["batch_size"],
+                                  workers=0, seed=config["seed"])
+        valLoader = make_loader(valSet, batch_size=config["batch_size"],
+                                workers=0, shuffle=False)
+
+        _warmUp(config, windowSize, trainLoader)
+        torch.manual_seed(config["seed"])
+        predict, trainEpoch, validate = _makeModels(config, windowSize)
+
+        # train / validate print their status, keep the sweep's output clean
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            for epoch in range(config["epochs"]):
+                trainEpoch(trainLoader, epoch)
+            trainSeconds = time.perf_counter() - start
+            # losses differ between the models (joint: smooth L1 over
+            # positive windows only), they rank on score_windows instead
+            val_loss, conf_loss, loc_loss = validate(valLoader)
+        # (validate left the models in eval mode)
+        result.update(score_windows(valLoader, predict))
+
+        result.update({"val_loss": val_loss, "conf_loss": conf_loss,
+                       "loc_loss": loc_loss, "train_s": trainSeconds,
+                       "images_per_sec": (len(trainSet) * config["epochs"] /
+                                          trainSeconds)})
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    return result
+
+
+def _initWorker(threads):
+    torch.set_num_threads(threads)
+
+
+def run_sweep(configs, files, procs=None, threads=1):
+    """
+    Run configs in a pool of procs processes with threads torch threads each
+    (default: as many processes as fit the cores)
+    : return: results, in the order runs finish
+    """
+    if procs is None:
+        procs = max(1, (os.cpu_count() or 1) // threads)
+    # window labels per (file, window setting), made here so the runs only
+    # ever read them
+    for config in configs:
+        try:
+            _datasets(config, files)
+        except Exception:
+            pass  # run_config reports it
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(
+            procs, mp_context=context, initializer=_initWorker,
+            initargs=(threads,)) as pool:
+        futures = [pool.submit(run_config, config, files)
+                   for config in configs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            status = (result["error"] if "error" in result
+                      else "success %.3f" % result["success"])
+            print("done %d/%d: %s" % (len(results), len(configs), status),
+                  file=sys.stderr)
+    return results
+
+
+def format_table(results, columns=COLUMNS):
+    """
+    Results as a text table, best grasp success first (validation losses
+    of the two model types are not comparable)
+    """
+    ok = sorted((r for r in results if "error" not in r),
+                key=lambda r: -r["success"])
+    failed = [r for r in results if "error" in r]
+    rows = [list(columns)]
+    for result in ok:
+        rows.append([("%.4g" % result[c]) if isinstance(result[c], float)
+                     else str(result[c]) for c in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths))
+             for row in rows]
+    for result in failed:
+        lines.append("failed: %s %s" % (
+            {k: result[k] for k in columns if k in result}, result["error"]))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="rcnn_depth hyperparameter sweep")
+    parser.add_argument("--models", nargs="+", default=["joint"],
+                        choices=["joint", "twopass"])
+    parser.add_argument("--windows", nargs="+", type=int,
+                        default=[windows.WINDOWSIZE[0]])
+    parser.add_argument("--steps", nargs="+", type=int,
+                        default=[windows.STEPSIZE])
+    parser.add_argument("--margins", nargs="+", type=int,
+                        default=[windows.MARGIN_PX])
+    parser.add_argument("--lrs", nargs="+", type=float, default=[0.001])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[15])
+    parser.add_argument("--blocks", nargs="+",
+                        default=["%dx%d" % (block_l, block_w)],
+                        help="block sizes as LxW")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--num-train", type=int, default=500)
+    parser.add_argument("--num-val", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--procs", type=int, help="default: cores / threads")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="torch threads per process")
+    parser.add_argument("--data-dir", default="Data/sweep")
+    parser.add_argument("--out", help="also append results here (.csv or "
+                                      ".jsonl)")
+    args = parser.parse_args()
+
+    files = make_datasets(args.data_dir, [_parseBlock(b) for b in args.blocks],
+                          args.num_train, args.num_val, args.seed)
+    results = run_sweep(make_configs(args), files, args.procs, args.threads)
+    print(format_table(results))
+
+    fields = list(COLUMNS) + ["epochs", "seed", "error"]
+    sink = make_sink(args.out, fields)
+    if sink is not None:
+        for result in results:
+            sink.write({k: result.get(k) for k in fields})
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+# Training loops
+# The two pass sliding window training (classifier, then the regressor on the
+# classifier's windows) and validation from v5_Sliding Window.py, as
+# functions of their loaders, models and device instead of script globals, so
+# they can be imported without side effects. train_joint trains a
+# multiTaskNet on both tasks in one pass. Checkpoints: checkpoint.py.
+
+import torch
+
+import fastcpu
+from instrument import Instrument
+
+_device = None
+
+
+def get_device():
+    """
+    cuda if available, else cpu; queried on first use instead of at import
+    """
+    global _device
+    if _device is None:
+        _device = torch.device("cuda:0" if torch.cuda.is_available()
+                               else "cpu")
+        print("CUDA available? device: ", _device)
+    return _device
+
+
+# -- Utility fxn -------------------------------------------------------
+# Source: https://github.com/sgrvinod/a-PyTorch-Tutorial-to-Object-Detection/blob/master/train.py
+
+
+class AverageMeter(object):
+    """
+    Keeps track of most recent, average, sum, and count of a metric.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.avg = 0
+        self.sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.val = val
+        self.sum += val * n
+        self.count += n
+        self.avg = self.sum / self.count
+
+
+# -- Define Train and Valid fxn -------------------------------------------------------
+
+def _printStatus(prefix, i_batch, num_batches, batch_time, losses):
+    print(
+        prefix +
+        "[{0}/{1}]\t"
+        "Batch Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t"
+        "Loss {loss.val:.4f} ({loss.avg:.4f})\t".format(
+            i_batch, num_batches, batch_time=batch_time, loss=losses
+        )
+    )
+
+
+def train(train_loader, classifModel, regrModel, classifCriterion,
+          regrCriterion, optimizer1, optimizer2, epoch, device=None,
+          print_freq=25, fast_cpu=False, instrument=None):
+    """
+    One epoch's training.
+    : param train_loader: DataLoader for training data
+    : param model: model
+    : param criterion: for classification (crop contains an Obj, t/f)
+    : param criterion: for regresion (of the x,y, theta)
+    : param optimizer: optimizer
+    : param epoch: epoch number
+    : param fast_cpu: bf16 autocast and channels last, see fastcpu.py
+    : param instrument: instrument.Instrument that gets per phase timings of
+        every batch
+    """
+    device = get_device() if device is None else device
+    inst = Instrument() if instrument is None else instrument
+
+    classifModel.train()  # training mode enables dropout
+    regrModel.train()  # training mode enables dropout
+
+    batch_time = AverageMeter()  # forward prop. + back prop. time
+    losses = AverageMeter()  # loss
+
+    inst.set(epoch=epoch, stage="classif")
+    for i_batch, (images, labels, coords) in enumerate(
+            inst.batches(train_loader)):
+        with inst.phase("load"):
+            images = images.to(device)
+            labels = labels.to(device)
+
+        # Forward pass (crops are made inside classifNet)
+        with inst.phase("forward"), fastcpu.autocast(fast_cpu):
+            predicted_class, all_crops = classifModel(images)
+            loss1 = classifCriterion(predicted_class.float(), labels)
+
+        with inst.phase("backward"):
+            optimizer1.zero_grad()
+            loss1.backward()
+
+        # Update model
+        with inst.phase("step"):
+            optimizer1.step()
+        losses.update(loss1.item())
+
+        record = inst.step(images=len(images), loss=losses.val)
+        batch_time.update(record["batch_s"])
+
+        # Print status
+        if i_batch % print_freq == 0:
+            _printStatus("Epoch: [%d]" % epoch, i_batch, len(train_loader),
+                         batch_time, losses)
+        # free some memory since their histories may be stored
+        del predicted_class, images, labels, all_crops
+
+    losses2 = AverageMeter()  # loss
+
+    inst.set(stage="regr")
+    for i_batch, (images, labels, coords) in enumerate(
+            inst.batches(train_loader)):
+        with inst.phase("load"):
+            images = images.to(device)
+            coords = coords.to(device)
+
+        # Crops and window labels from the classifier, no gradients needed
+        with inst.phase("crop"), torch.no_grad(), \
+                fastcpu.autocast(fast_cpu):
+            predicted_class, all_crops = classifModel(images)
+            labelly = predicted_class.detach()
+
+        # Forward pass
+        with inst.phase("forward"), fastcpu.autocast(fast_cpu):
+            predicted_coords = regrModel(
+                fastcpu.to_layout(all_crops, fast_cpu), labelly)
+            loss2 = regrCriterion(predicted_coords.float(), coords)
+
+        with inst.phase("backward"):
+            optimizer2.zero_grad()
+            loss2.backward()
+
+        with inst.phase("step"):
+            optimizer2.step()
+
+        losses2.update(loss2.item())
+
+        record = inst.step(images=len(images), loss=losses2.val)
+        batch_time.update(record["batch_s"])
+
+        # Print status
+        if i_batch % print_freq == 0:
+            _printStatus("Epoch: [%d]" % epoch, i_batch, len(train_loader),
+                         batch_time, losses2)
+        # free some memory since their histories may be stored
+        del predicted_class, predicted_coords, images, coords, all_crops
+
+    return losses.avg, losses2.avg
+
+
+def validate(val_loader, c_model, r_model, c_criterion, r_criterion,
+             device=None, print_freq=25, instrument=None):
+    """
+    One epoch's validation.
+    : param val_loader: DataLoader for validation data
+    : param model: model
+    : param criterion: MultiBox loss
+    : return: average validation loss
+    """
+    device = get_device() if device is None else device
+    inst = Instrument() if instrument is None else instrument
+
+    c_model.eval()  # eval mode disables dropout
+    r_model.eval()  # eval mode disables dropout
+
+    batch_time = AverageMeter()
+    losses = AverageMeter()
+    losses2 = AverageMeter()
+
+    inst.set(stage="val")
+    # Prohibit gradient computation explicity because I had some problems with memory
+    with torch.no_grad():
+        # Batches
+        for i_batch, (images, labels, coords) in enumerate(
+                inst.batches(val_loader)):
+            # Move to default device
+            with inst.phase("load"):
+                images = images.to(device)
+                labels = labels.to(device)
+                coords = coords.to(device)
+
+            with inst.phase("forward"):
+                predicted_class, all_crops = c_model(images)
+                loss = c_criterion(predicted_class, labels)
+
+                labelly = predicted_class.detach()
+                predicted_coords = r_model(all_crops, labelly)
+
+                loss2 = r_criterion(predicted_coords, coords)
+
+            losses.update(loss.item())
+            losses2.update(loss2.item())
+
+            record = inst.step(images=len(images), loss=losses.val,
+                               loss2=losses2.val)
+            batch_time.update(record["batch_s"])
+
+            # Print status
+            if i_batch % print_freq == 0:
+                _printStatus("", i_batch, len(val_loader), batch_time, losses)
+
+    print("\n * LOSS - {loss.avg:.3f}\n".format(loss=losses))
+
+    return losses.avg, losses2.avg
+
+
+def train_joint(train_loader, model, criterion, optimizer, epoch,
+                device=None, print_freq=25, fast_cpu=False, instrument=None):
+    """
+    One epoch's training of a multiTaskNet, both heads in a single pass
+    : param criterion: MultiObjLoss
+    : return: average total, classification and location losses
+    """
+    device = get_device() if device is None else device
+    inst = Instrument() if instrument is None else instrument
+
+    model.train()  # training mode enables dropout
+
+    batch_time = AverageMeter()  # forward prop. + back prop. time
+    losses = AverageMeter()  # loss
+    conf_losses = AverageMeter()
+    loc_losses = AverageMeter()
+
+    inst.set(epoch=epoch, stage="joint")
+    for i_batch, (images, labels, coords) in enumerate(
+            inst.batches(train_loader)):
+        with inst.phase("load"):
+            images = images.to(device)
+            labels = labels.to(device)
+            coords = coords.to(device)
+
+        # Forward pass
+        with inst.phase("forward"), fastcpu.autocast(fast_cpu):
+            predicted_class, predicted_coords = model(images)
+            loss, conf_loss, loc_loss = criterion(
+                predicted_class, predicted_coords, labels, coords)
+
+        with inst.phase("backward"):
+            optimizer.zero_grad()
+            loss.backward()
+
+        # Update model
+        with inst.phase("step"):
+            optimizer.step()
+        losses.update(loss.item())
+        conf_losses.update(conf_loss.item())
+        loc_losses.update(loc_loss.item())
+
+        record = inst.step(images=len(images), loss=losses.val,
+                           conf_loss=conf_losses.val, loc_loss=loc_losses.val)
+        batch_time.update(record["batch_s"])
+
+        # Print status
+        if i_batch % print_freq == 0:
+            _printStatus("Epoch: [%d]" % epoch, i_batch, len(train_loader),
+                         batch_time, losses)
+        # free some memory since their histories may be stored
+        del predicted_class, predicted_coords, images, labels, coords
+
+    return losses.avg, conf_losses.avg, loc_losses.avg
+
+
+def validate_joint(val_loader, model, criterion, device=None, print_freq=25,
+                   instrument=None):
+    """
+    One epoch's validation of a multiTaskNet
+    : return: average total, classification and location losses
+    """
+    device = get_device() if device is None else device
+    inst = Instrument() if instrument is None else instrument
+
+    model.eval()  # eval mode disables dropout
+
+    batch_time = AverageMeter()
+    losses = AverageMeter()
+    conf_losses = AverageMeter()
+    loc_losses = AverageMeter()
+
+    inst.set(stage="val")
+    with torch.no_grad():
+        for i_batch, (images, labels, coords) in enumerate(
+                inst.batches(val_loader)):
+            with inst.phase("load"):
+                images = images.to(device)
+                labels = labels.to(device)
+                coords = coords.to(device)
+
+            with inst.phase("forward"):
+                predicted_class, predicted_coords = model(images)
+                loss, conf_loss, loc_loss = criterion(
+                    predicted_class, predicted_coords, labels, coords)
+
+            losses.update(loss.item())
+            conf_losses.update(conf_loss.item())
+            loc_losses.update(loc_loss.item())
+
+            record = inst.step(images=len(images), loss=losses.val,
+                               conf_loss=conf_losses.val,
+                               loc_loss=loc_losses.val)
+            batch_time.update(record["batch_s"])
+
+            # Print status
+            if i_batch % print_freq == 0:
+                _printStatus("", i_batch, len(val_loader), batch_time, losses)
+
+    print("\n * LOSS - {loss.avg:.3f}\n".format(loss=losses))
+
+    return losses.avg, conf_losses.avg, loc_losses.avg
@@ -0,0 +1,110 @@
+# Sliding windows
+# Crops for a whole batch come from one strided view of the images, instead
+# of slicing every window of every image in python loops. Window labels only
+# depend on the rectangle centers and the fixed window grid, so they are
+# computed for a whole dataset at once and cached next to it.
+
+import os
+
+import numpy as np
+
+STEPSIZE = 50
+WINDOWSIZE = (100, 100)
+MARGIN_PX = 15
+
+
+def cropGridShape(imgShape, windowSize=WINDOWSIZE, stepSize=STEPSIZE):
+    """
+    Number of window rows and columns that fit in an (IMG_Y, IMG_X) image
+    """
+    ny = (imgShape[0] - windowSize[0]) // stepSize + 1
+    nx = (imgShape[1] - windowSize[1]) // stepSize + 1
+    return max(ny, 0), max(nx, 0)
+
+
+def numCrops(imgShape, windowSize=WINDOWSIZE, stepSize=STEPSIZE):
+    ny, nx = cropGridShape(imgShape, windowSize, stepSize)
+    return ny * nx
+
+
+def windowView(images, windowSize=WINDOWSIZE, stepSize=STEPSIZE):
+    """
+    All windows of a batch as one view, no data is copied
+    : param images: (H, W), (N, H, W) or (N, 1, H, W) tensor
+    : return: (N, ny, nx, windowSize[0], windowSize[1]) view
+    """
+    if images.dim() == 2:
+        images = images.unsqueeze(0)
+    elif images.dim() == 4:
+        images = images.squeeze(1)
+    return images.unfold(1, windowSize[0], stepSize).unfold(
+        2, windowSize[1], stepSize)
+
+
+def makeCrops(images, windowSize=WINDOWSIZE, stepSize=STEPSIZE):
+    """
+    Crops of a batch, ordered like the old loops (rows of y, then x)
+    : return: (N, numCrops, windowSize[0], windowSize[1]); a view when the
+        windows tile the image exactly, otherwise a single gather copy
+    """
+    view = windowView(images, windowSize, stepSize)
+    return view.reshape(view.shape[0], -1, windowSize[0], windowSize[1])
+
+
+def windowGrid(imgShape, windowSize=WINDOWSIZE, stepSize=STEPSIZE):
+    """
+    Top left corner of every window, in the same order as makeCrops
+    : return: ys, xs int arrays of shape (numCrops,)
+    """
+    ny, nx = cropGridShape(imgShape, windowSize, stepSize)
+    ys = np.repeat(np.arange(ny) * stepSize, nx)
+    xs = np.tile(np.arange(nx) * stepSize, ny)
+    return ys, xs
+
+
+def labelWindows(coords, grid, windowSize=WINDOWSIZE, margin=MARGIN_PX):
+    """
+    Ground truth of every window of every image, in one broadcast
+    : param coords: (N, 3) rectangle (x, y, theta) per image, or (N, R, 3)
+        for scenes with several rectangles
+    : param grid: (ys, xs) from windowGrid
+    : return: hasRects (N, numCrops) bool, rectCoords (N, numCrops, 3) with
+        the (first) contained rectangle's (x, y, theta), zeros elsewhere
+    """
+    coords = np.asarray(coords, dtype=np.float32)
+    if coords.ndim == 2:
+        coords = coords[:, None, :]
+    ys, xs = grid[0][:, None], grid[1][:, None]
+    # (N, numCrops, R)
+    c_x, c_y = coords[:, None, :, 0], coords[:, None, :, 1]
+    inWindow = (xs + margin < c_x) & (c_x < xs + windowSize[1] - margin)
+    inWindow &= (ys + margin < c_y) & (c_y < ys + windowSize[0] - margin)
+    hasRects = inWindow.any(axis=-1)
+    first = inWindow.argmax(axis=-1)
+    rectCoords = np.take_along_axis(coords, first[..., None], axis=1)
+    # NOTE: empty label (0, 0, 0) when not hasRect
+    rectCoords = np.where(hasRects[..., None], rectCoords, np.float32(0))
+    return hasRects, rectCoords
+
+
+def cachedWindowLabels(cacheFile, coords, imgShape, windowSize=WINDOWSIZE,
+                       stepSize=STEPSIZE, margin=MARGIN_PX):
+    """
+    labelWindows for a dataset, saved to cacheFile (.npz) the first time and
+    loaded afterwards as long as the coords and window settings match
+    """
+    coords = np.asarray(coords, dtype=np.float32)
+    params = np.array([imgShape[0], imgShape[1], windowSize[0],
+                       windowSize[1], stepSize, margin], dtype=np.float64)
+    if os.path.exists(cacheFile):
+        cache = np.load(cacheFile)
+        if (np.array_equal(cache["params"], params) and
+                np.array_equal(cache["coords"], coords)):
+            # arrays read out of an npz are read only, torch wants writable
+            return np.array(cache["hasRects"]), np.array(cache["rectCoords"])
+
+    grid = windowGrid(imgShape, windowSize, stepSize)
+    hasRects, rectCoords = labelWindows(coords, grid, windowSize, margin)
+    np.savez(cacheFile, params=params, coords=coords, hasRects=hasRects,
+             rectCoords=rectCoords)
+    return hasRects, rectCoords
@@ -0,0 +1,264 @@
+# Darknet cfg networks
+# parse_cfg reads a darknet .cfg (yolov3.cfg and friends) into blocks,
+# create_modules builds them ([convolutional], [maxpool], [upsample],
+# [route], [shortcut], [yolo]) and Darknet runs them: one forward pass over
+# the whole image gives every detection, no sliding windows. [yolo] blocks
+# with rotated=1 predict grasps, (x, y, theta) plus block size, decoded by
+# util.predict_transform / util.decode_grasps. cfg/grasp-tiny.cfg is sized
+# for our 200x200 single channel depth images and runs in real time on CPU.
+#
+# Run from rcnn_depth:
+# python -m yolo.darknet yolo/cfg/grasp-tiny.cfg  # layers and CPU speed
+# python -m yolo.darknet yolo/cfg/grasp-tiny.cfg --train 2000 --out grasp.pth
+#
+# model = Darknet("yolo/cfg/grasp-tiny.cfg")
+# dets, imageIdx = decode_grasps(model(images))
+
+import torch
+import torch.nn as nn
+
+from yolo.util import num_attrs, predict_transform, grasp_loss
+
+
+def parse_cfg(cfgfile):
+    """
+    : return: list of blocks, each a dict of its options (strings) with the
+        section name under "type"; the first one is [net]
+    """
+    blocks = []
+    block = None
+    with open(cfgfile) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith("["):
+                block = {"type": line[1:-1].strip()}
+                blocks.append(block)
+            else:
+                key, value = line.split("=", 1)
+                block[key.strip()] = value.strip()
+    return blocks
+
+
+def _ints(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
+class EmptyLayer(nn.Module):
+    """
+    Placeholder for [route] and [shortcut], Darknet.forward does the work
+    """
+
+    def __init__(self, layers):
+        super(EmptyLayer, self).__init__()
+        self.layers = layers
+
+
+class YoloLayer(nn.Module):
+    def __init__(self, anchors, num_classes, rotated):
+        super(YoloLayer, self).__init__()
+        self.anchors = anchors
+        self.num_classes = num_classes
+        self.rotated = rotated
+
+    def forward(self, x, inp_dim):
+        return predict_transform(x, inp_dim, self.anchors, self.num_classes,
+                                 self.rotated)
+
+
+def create_modules(blocks):
+    """
+    : return: net_info (the [net] block), module_list with one module per
+        remaining block
+    """
+    net_info = blocks[0]
+    module_list = nn.ModuleList()
+    channels = int(net_info.get("channels", 3))
+    out_channels = []
+
+    for index, block in enumerate(blocks[1:]):
+        module = nn.Sequential()
+        kind = block["type"]
+
+        if kind == "convolutional":
+            bn = int(block.get("batch_normalize", 0))
+            filters = int(block["filters"])
+            size = int(block["size"])
+            stride = int(block.get("stride", 1))
+            pad = (size - 1) // 2 if int(block.get("pad", 0)) else 0
+            module.add_module("conv_%d" % index, nn.Conv2d(
+                channels, filters, size, stride, pad, bias=not bn))
+            if bn:
+                module.add_module("batch_norm_%d" % index,
+                                  nn.BatchNorm2d(filters))
+            activation = block.get("activation", "linear")
+            if activation == "leaky":
+                module.add_module("leaky_%d" % index,
+                                  nn.LeakyReLU(0.1, inplace=True))
+            elif activation == "relu":
+                module.add_module("relu_%d" % index, nn.ReLU(inplace=True))
+            elif activation != "linear":
+                raise ValueError("unknown activation %s" % activation)
+            channels = filters
+
+        elif kind == "maxpool":
+            size = int(block["size"])
+            stride = int(block.get("stride", size))
+            if size == 2 and stride == 1:
+                # yolov3-tiny keeps the size: pad right and bottom
+                module.add_module("pad_%d" % index,
+                                  nn.ZeroPad2d((0, 1, 0, 1)))
+            module.add_module("maxpool_%d" % index, nn.MaxPool2d(
+                size, stride, padding=(size - 1) // 2 if size > 2 else 0))
+
+        elif kind == "upsample":
+            module.add_module("upsample_%d" % index, nn.Upsample(
+                scale_factor=int(block.get("stride", 2)), mode="nearest"))
+
+        elif kind == "route":
+            # negative layers count back from this one
+            layers = [l if l >= 0 else index + l
+                      for l in _ints(block["layers"])]
+            module.add_module("route_%d" % index, EmptyLayer(layers))
+            channels = sum(out_channels[l] for l in layers)
+
+        elif kind == "shortcut":
+            layers = [index + int(block["from"])]
+            module.add_module("shortcut_%d" % index, EmptyLayer(layers))
+
+        elif kind == "yolo":
+            anchors = _ints(block["anchors"])
+            anchors = [(anchors[i], anchors[i + 1])
+                       for i in range(0, len(anchors), 2)]
+            mask = _ints(block.get("mask", ",".join(
+                str(i) for i in range(len(anchors)))))
+            rotated = bool(int(block.get("rotated", 0)))
+            num_classes = int(block.get("classes", 0))
+            layer = YoloLayer([anchors[i] for i in mask], num_classes,
+                              rotated)
+            expected = len(mask) * num_attrs(num_classes, rotated)
+            if channels != expected:
+                raise ValueError("[yolo] block %d needs %d filters before it,"
+                                 " got %d" % (index, expected, channels))
+            module.add_module("yolo_%d" % index, layer)
+
+        else:
+            raise ValueError("unknown cfg block [%s]" % kind)
+
+        module_list.append(module)
+        out_channels.append(channels)
+
+    return net_info, module_list
+
+
+class Darknet(nn.Module):
+    def __init__(self, cfgfile):
+        super(Darknet, self).__init__()
+        self.blocks = parse_cfg(cfgfile)
+        self.net_info, self.module_list = create_modules(self.blocks)
+        self.inp_dim = (int(self.net_info.get("height", 416)),
+                        int(self.net_info.get("width", 416)))
+        self.channels = int(self.net_info.get("channels", 3))
+
+    def forward(self, x, targets=None):
+        """
+        : param x: (N, C, H, W) images, or (N, H, W) depth images
+        : param targets: (N, 3) or (N, R, 3) block (x, y, theta); with them
+            the loss of the rotated [yolo] layers comes back instead (other
+            [yolo] layers have no grasp loss and are skipped)
+        : return: (N, rows, attrs) detections of all [yolo] layers (see
+            util.predict_transform), or total, objectness and box loss
+        """
+        x = x.to(next(self.parameters()).device).float()
+        if x.dim() == 3:
+            x = x.unsqueeze(1)
+        inp_dim = tuple(x.shape[-2:])
+        outputs = []
+        detections = []
+        losses = []
+
+        for module, block in zip(self.module_list, self.blocks[1:]):
+            kind = block["type"]
+            if kind == "route":
+                x = torch.cat([outputs[l] for l in module[0].layers], 1)
+            elif kind == "shortcut":
+                x = outputs[-1] + outputs[module[0].layers[0]]
+            elif kind == "yolo":
+                layer = module[0]
+                if targets is None:
+                    detections.append(layer(x, inp_dim))
+                elif layer.rotated:
+                    losses.append(grasp_loss(x, targets.to(x.device),
+                                             inp_dim, layer.anchors))
+            else:
+                x = module(x)
+            outputs.append(x)
+
+        if targets is not None:
+            if not losses:
+                raise ValueError("no [yolo] block with rotated=1, nothing to "
+                                 "train on grasp targets")
+            return tuple(sum(parts) for parts in zip(*losses))
+        return torch.cat(detections, 1)
+
+
+def main():
+    import argparse
+    import time
+
+    from rectdata import ProceduralDepthDataset, make_loader
+
+    parser = argparse.ArgumentParser(
+        description="build a darknet cfg, time it on CPU, optionally train it"
+                    " on procedural depth images")
+    parser.add_argument("cfg")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="for timing")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--train", type=int, default=0,
+                        help="train on this many images")
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--out", help="save the state_dict here")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = Darknet(args.cfg)
+    numParams = sum(p.numel() for p in model.parameters())
+    x = torch.zeros(args.batch_size, model.channels, *model.inp_dim)
+    with torch.no_grad():
+        print("%s: %d blocks, %d parameters, input %s, output %s" % (
+            args.cfg, len(model.module_list), numParams, tuple(x.shape),
+            tuple(model.eval()(x).shape)))
+
+    if args.train:
+        loader = make_loader(ProceduralDepthDataset(args.train, seed=0),
+                             batch_size=16, workers=2)
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        model.train()
+        for i_batch, (images, coords) in enumerate(loader):
+            loss, objLoss, boxLoss = model(images.float() / 255, coords)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if i_batch % 25 == 0:
+                print("batch %d loss %.4f (objectness %.4f, box %.4f)" % (
+                    i_batch, loss.item(), objLoss.item(), boxLoss.item()))
+        if args.out:
+            torch.save(model.state_dict(), args.out)
+
+    model.eval()
+    with torch.no_grad():
+        model(x)  # warm up
+        repeats = 20
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+        seconds = (time.perf_counter() - start) / repeats
+    print("%.1f ms per batch of %d, %.0f images/sec" % (
+        seconds * 1000, args.batch_size, args.batch_size / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# YOLO output decoding, targets and loss
+# predict_transform turns the raw (N, anchors * attrs, G, G) output of a
+# [yolo] layer into one row per cell and anchor in image pixels. Plain yolov3
+# layers give (x, y, w, h, objectness, classes); rotated layers (rotated=1,
+# for grasps) give (x, y, theta, l, w, objectness, classes), theta from a
+# (sin 2 theta, cos 2 theta) pair because blocks look the same turned by 180
+# degrees. decode_grasps merges the rows of a batch into detections with the
+# same rotated NMS as the sliding window detector (detect.py), so both give
+# (x, y, theta, score) per block.
+#
+# Run from rcnn_depth, yolo is imported as a package:
+# from yolo.darknet import Darknet
+# from yolo.util import decode_grasps
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from rectgen import block_l, block_w
+from detect import nms
+
+BOX_ATTRS = 5  # x, y, w, h, objectness
+GRASP_ATTRS = 7  # x, y, l, w, sin 2 theta, cos 2 theta, objectness
+
+
+def num_attrs(num_classes, rotated=False):
+    """
+    Outputs per anchor of a [yolo] layer
+    """
+    return (GRASP_ATTRS if rotated else BOX_ATTRS) + num_classes
+
+
+def _cells(prediction, num_anchors, attrs):
+    # (N, A * attrs, G, G) -> (N, G, G, A, attrs)
+    N, _, gy, gx = prediction.shape
+    prediction = prediction.view(N, num_anchors, attrs, gy, gx)
+    return prediction.permute(0, 3, 4, 1, 2)
+
+
+def predict_transform(prediction, inp_dim, anchors, num_classes,
+                      rotated=False):
+    """
+    Decode one [yolo] layer
+    : param prediction: raw (N, A * attrs, G_y, G_x) layer input
+    : param inp_dim: (height, width) of the network input in pixels
+    : param anchors: A (w, h) anchor sizes in pixels ((l, w) when rotated)
+    : return: (N, G_y * G_x * A, attrs) rows, boxes in input pixels
+    """
+    num_anchors = len(anchors)
+    attrs = num_attrs(num_classes, rotated)
+    p = _cells(prediction, num_anchors, attrs).float()
+    N, gy, gx = p.shape[:3]
+    stride_y, stride_x = inp_dim[0] / gy, inp_dim[1] / gx
+
+    cy, cx = torch.meshgrid(torch.arange(gy, device=p.device),
+                            torch.arange(gx, device=p.device), indexing="ij")
+    anchors = torch.as_tensor(anchors, dtype=p.dtype, device=p.device)
+
+    x = (torch.sigmoid(p[..., 0]) + cx[..., None]) * stride_x
+    y = (torch.sigmoid(p[..., 1]) + cy[..., None]) * stride_y
+    size = torch.exp(p[..., 2:4].clamp(max=10)) * anchors
+    if rotated:
+        theta = torch.remainder(
+            torch.atan2(p[..., 4], p[..., 5]) / 2, math.pi)
+        rows = [x[..., None], y[..., None], theta[..., None], size,
+                torch.sigmoid(p[..., 6:])]
+    else:
+        rows = [x[..., None], y[..., None], size, torch.sigmoid(p[..., 4:])]
+    return torch.cat(rows, -1).reshape(N, -1, attrs - rotated)
+
+
+def decode_grasps(detections, threshold=0.5, iouThreshold=0.3, l=block_l,
+                  w=block_w):
+    """
+    One detection per block from the rows of a rotated [yolo] layer
+    (Darknet.forward), like detect.decodeDetections
+    : return: dets (M, 4) as (x, y, theta, score), imageIdx (M,)
+    """
+    scores = detections[..., 5]
+    n_idx, k_idx = (scores > threshold).nonzero(as_tuple=True)
+    boxes = detections[n_idx, k_idx, :3]
+    scores = scores[n_idx, k_idx]
+    keep = nms(boxes, scores, iouThreshold, imageIdx=n_idx, l=l, w=w)
+    dets = torch.cat((boxes[keep], scores[keep, None]), dim=1)
+    return dets, n_idx[keep]
+
+
+# -- Training -------------------------------------------------------
+
+
+def build_targets(coords, grid, inp_dim, anchors, l=block_l, w=block_w):
+    """
+    Grasp targets of a rotated [yolo] layer: the cell holding a block's
+    center and the anchor closest to its size predict it
+    : param coords: (N, 3) or (N, R, 3) block (x, y, theta) in input pixels
+    : param grid: (G_y, G_x) of the layer
+    : return: mask (N, G_y, G_x, A) bool, target (N, G_y, G_x, A, 6) as
+        (x, y offset in the cell, log l / anchor, log w / anchor,
+        sin 2 theta, cos 2 theta)
+    """
+    coords = coords.reshape(len(coords), -1, 3).float()
+    N, R = coords.shape[:2]
+    device = coords.device
+    stride_y, stride_x = inp_dim[0] / grid[0], inp_dim[1] / grid[1]
+    anchors = torch.as_tensor(anchors, dtype=torch.float32, device=device)
+
+    gx = (coords[..., 0] / stride_x).clamp(0, grid[1] - 1e-3)
+    gy = (coords[..., 1] / stride_y).clamp(0, grid[0] - 1e-3)
+    ix, iy = gx.long(), gy.long()
+    logSize = torch.log(torch.tensor([l, w], dtype=torch.float32,
+                                     device=device) / anchors)
+    best = logSize.abs().sum(-1).argmin()
+
+    mask = torch.zeros(N, grid[0], grid[1], len(anchors), dtype=torch.bool,
+                       device=device)
+    target = torch.zeros(N, grid[0], grid[1], len(anchors), 6, device=device)
+    n = torch.arange(N, device=device)[:, None].expand(N, R)
+    mask[n, iy, ix, best] = True
+    target[n, iy, ix, best] = torch.stack(
+        (gx - ix, gy - iy, logSize[best, 0].expand(N, R),
+         logSize[best, 1].expand(N, R), torch.sin(2 * coords[..., 2]),
+         torch.cos(2 * coords[..., 2])), -1)
+    return mask, target
+
+
+def grasp_loss(prediction, coords, inp_dim, anchors, l=block_l, w=block_w,
+               noobj_scale=1.0):
+    """
+    Loss of one rotated [yolo] layer: objectness BCE over every cell and
+    anchor, box terms only where there is a block
+    : param prediction: raw (N, A * attrs, G_y, G_x) layer input
+    : return: total, objectness part, box part
+    """
+    p = _cells(prediction, len(anchors), GRASP_ATTRS).float()
+    mask, target = build_targets(coords, p.shape[1:3], inp_dim, anchors, l,
+                                 w)
+    obj = p[..., 6]
+    objLoss = F.binary_cross_entropy_with_logits(
+        obj, mask.float(), reduction="none")
+    objLoss = (objLoss[mask].sum() +
+               noobj_scale * objLoss[~mask].sum()) / len(p)
+
+    positive = p[mask]
+    expected = target[mask]
+    boxLoss = (F.mse_loss(torch.sigmoid(positive[:, :2]), expected[:, :2],
+                          reduction="sum") +
+               F.mse_loss(positive[:, 2:6], expected[:, 2:6],
+                          reduction="sum")) / len(p)
+    return objLoss + boxLoss, objLoss, boxLoss